@@ -0,0 +1,241 @@
+import os
+import json
+import glob
+import atexit
+import struct
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import pygame as pg
+
+MANIFEST_PATH = 'static/assets.json'
+CACHE_PATH = 'static/.asset_cache'
+CACHE_HEADER = struct.Struct('<4sHI')  # magic, version, entry count
+CACHE_ENTRY = struct.Struct('<H20sH')  # key length, source sha1, surface count
+CACHE_SURFACE = struct.Struct('<HHBI')  # width, height, has alpha, byte count
+CACHE_MAGIC = b'PACH'
+CACHE_VERSION = 1
+
+
+def asset_key(path):
+    return os.path.normpath(path.replace('\\', '/'))
+
+
+class SurfaceCache:
+    """Raw pixel buffers of decoded and derived surfaces, keyed by the sha1 of their source file"""
+
+    def __init__(self, path=CACHE_PATH):
+        self.path = path
+        self.entries = None  # key -> (digest, [(size, mode, bytes)])
+        self.sources = {}  # source path -> digests it has entries for
+        self.dirty = False
+
+    def get_entries(self):
+        if self.entries is None:
+            self.entries = {}
+            if os.path.isfile(self.path):
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+                try:
+                    self.entries = self.parse(data)
+                except (struct.error, ValueError, UnicodeDecodeError):
+                    self.entries = {}
+            for key, (digest, surfaces) in self.entries.items():
+                self.sources.setdefault(key.rsplit(':', 1)[0], set()).add(digest)
+        return self.entries
+
+    def has_source(self, path, digest):
+        self.get_entries()
+        return digest in self.sources.get(path, ())
+
+    @staticmethod
+    def parse(data):
+        entries = {}
+        view = memoryview(data)
+        magic, version, count = CACHE_HEADER.unpack_from(data, 0)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            return entries
+        offset = CACHE_HEADER.size
+        for _ in range(count):
+            key_length, digest, surface_count = CACHE_ENTRY.unpack_from(data, offset)
+            offset += CACHE_ENTRY.size
+            key = bytes(view[offset:offset + key_length]).decode()
+            offset += key_length
+            surfaces = []
+            for _ in range(surface_count):
+                w, h, alpha, length = CACHE_SURFACE.unpack_from(data, offset)
+                offset += CACHE_SURFACE.size
+                surfaces.append(((w, h), 'RGBA' if alpha else 'RGB', view[offset:offset + length]))
+                offset += length
+            entries[key] = (digest, surfaces)
+        return entries
+
+    def get(self, key, digest):
+        entry = self.get_entries().get(key)
+        if entry is None or entry[0] != digest:
+            return None
+        surfaces = []
+        for size, mode, pixels in entry[1]:
+            surface = pg.image.frombuffer(pixels, size, mode)
+            surfaces.append(surface.convert_alpha() if mode == 'RGBA' else surface.convert())
+        return surfaces
+
+    def put(self, key, digest, surfaces):
+        records = []
+        for surface in surfaces:
+            mode = 'RGBA' if surface.get_flags() & pg.SRCALPHA else 'RGB'
+            records.append((surface.get_size(), mode, pg.image.tobytes(surface, mode)))
+        self.get_entries()[key] = (digest, records)
+        self.sources.setdefault(key.rsplit(':', 1)[0], set()).add(digest)
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        # entries whose source file has gone are dropped, the rest are written back in one go
+        entries = {key: entry for key, entry in self.get_entries().items()
+                   if os.path.isfile(key.rsplit(':', 1)[0])}
+        parts = [CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(entries))]
+        for key, (digest, surfaces) in entries.items():
+            encoded = key.encode()
+            parts.append(CACHE_ENTRY.pack(len(encoded), digest, len(surfaces)))
+            parts.append(encoded)
+            for size, mode, pixels in surfaces:
+                parts.append(CACHE_SURFACE.pack(size[0], size[1], mode == 'RGBA', len(pixels)))
+                parts.append(bytes(pixels))
+        with open(self.path, 'wb') as f:
+            f.write(b''.join(parts))
+        self.dirty = False
+
+
+class AssetLoader:
+    """Decodes images on worker threads and converts them on the main thread when first requested"""
+
+    def __init__(self, manifest_path=MANIFEST_PATH, workers=4, cache_path=CACHE_PATH):
+        self.manifest_path = manifest_path
+        self.groups = None
+        self.workers = workers
+        self.executor = None
+        self.decoding = {}  # path -> future of (source digest, decoded unconverted surface or None when cached)
+        self.images = {}  # (path, variant) -> list of converted surfaces
+        self.digests = {}
+        self.started_groups = set()
+        self.cache = SurfaceCache(cache_path) if cache_path else None
+        atexit.register(self.save_cache)
+
+    def get_groups(self):
+        # read on first use, since asset paths are relative to the working directory
+        if self.groups is None:
+            self.groups = {}
+            if os.path.isfile(self.manifest_path):
+                with open(self.manifest_path, 'r') as f:
+                    self.groups = json.load(f)['groups']
+        return self.groups
+
+    def group_paths(self, group):
+        paths = []
+        for pattern in self.get_groups()[group]['paths']:
+            paths.extend(asset_key(path) for path in sorted(glob.glob(pattern, recursive=True)))
+        return paths
+
+    def group_of(self, path):
+        for group in self.get_groups():
+            if group not in self.started_groups and path in self.group_paths(group):
+                return group
+        return None
+
+    @staticmethod
+    def hash_file(path):
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).digest()
+
+    def source_digest(self, path):
+        if path not in self.digests:
+            future = self.decoding.get(path)
+            self.digests[path] = future.result()[0] if future is not None else self.hash_file(path)
+        return self.digests[path]
+
+    def prepare(self, path):
+        # worker job: hash the source and only decode it when the disk cache has nothing current for it
+        if self.cache is None:
+            return None, pg.image.load(path)
+        digest = self.hash_file(path)
+        return digest, None if self.cache.has_source(path, digest) else pg.image.load(path)
+
+    def preload(self, groups=None):
+        """Start decoding the given groups, or every group not marked lazy"""
+        if groups is None:
+            groups = [group for group, entry in self.get_groups().items() if not entry.get('lazy')]
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='assets')
+        if self.cache is not None:
+            self.cache.get_entries()  # read here so the workers only look entries up
+        for group in groups:
+            self.started_groups.add(group)
+            for path in self.group_paths(group):
+                if path not in self.decoding:
+                    self.decoding[path] = self.executor.submit(self.prepare, path)
+
+    def decode(self, path):
+        if path not in self.decoding:
+            # first use of a lazy group pulls the rest of the group in behind it
+            group = self.group_of(path)
+            if group is not None:
+                self.preload([group])
+        future = self.decoding.get(path)
+        image = future.result()[1] if future is not None else None
+        return image if image is not None else pg.image.load(path)
+
+    def load_variants(self, path, variant, build, color_key=None):
+        """Surfaces derived from one source image by build(decoded), read from the disk cache when it is current"""
+        path = asset_key(path)
+        if color_key:
+            return self.with_color_key(path, variant, self.load_variants(path, variant, build), color_key)
+        surfaces = self.images.get((path, variant))
+        if surfaces is not None:
+            return surfaces
+        digest = self.source_digest(path) if self.cache is not None else None
+        if digest is not None:
+            surfaces = self.cache.get(f"{path}:{variant}", digest)
+        if surfaces is None:
+            surfaces = build(self.decode(path))
+            if digest is not None:
+                self.cache.put(f"{path}:{variant}", digest, surfaces)
+        self.images[(path, variant)] = surfaces
+        return surfaces
+
+    def with_color_key(self, path, variant, surfaces, color_key):
+        # the surfaces handed out are shared, so keyed ones are copies kept under their own key
+        key = (path, f"{variant}:{tuple(color_key)}")
+        if key not in self.images:
+            self.images[key] = [surface.copy() for surface in surfaces]
+            for surface in self.images[key]:
+                surface.set_colorkey(color_key)
+        return self.images[key]
+
+    def load(self, path, alpha=True, color_key=None):
+        if alpha:
+            return self.load_variants(path, 'alpha', lambda image: [image.convert_alpha()], color_key)[0]
+        return self.load_variants(path, 'opaque', lambda image: [image.convert()], color_key)[0]
+
+    def save_cache(self):
+        if self.cache is not None:
+            self.cache.save()
+
+
+ASSETS = AssetLoader()
+
+
+def preload_assets(groups=None):
+    ASSETS.preload(groups)
+
+
+def save_asset_cache():
+    ASSETS.save_cache()
+
+
+def load_image(path, alpha=True, color_key=None):
+    return ASSETS.load(path, alpha, color_key)
+
+
+def load_image_variants(path, variant, build, color_key=None):
+    return ASSETS.load_variants(path, variant, lambda image: build(image.convert_alpha()), color_key)
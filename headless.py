@@ -0,0 +1,106 @@
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+import sys
+import json
+import time
+import random
+import argparse
+import pygame as pg
+import main
+
+# (tick, direction, pressed) events repeated every SCRIPT_PERIOD ticks
+DEFAULT_SCRIPT = [(0, 'right', True), (40, 'up', True), (46, 'up', False), (52, 'up', True), (58, 'up', False),
+                  (120, 'right', False), (121, 'left', True), (160, 'up', True), (166, 'up', False),
+                  (239, 'left', False)]
+SCRIPT_PERIOD = 240
+
+
+def create_game(seed=0, streamed=False):
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    pg.display.init()
+    pg.display.set_mode((1, 1))
+    main.preload_assets(['tiles', 'player'])
+    random.seed(seed)
+    controller = main.Controller()
+    screen = main.GameScreen(controller, streamed)
+    controller.screen = screen
+    return controller, screen
+
+
+def load_script(path=None):
+    if path is None:
+        return DEFAULT_SCRIPT, SCRIPT_PERIOD
+    with open(path, 'r') as f:
+        data = json.load(f)
+    return [tuple(event) for event in data['events']], data.get('period', 0)
+
+
+def script_events(script):
+    events = {}
+    for tick, direction, pressed in script:
+        key = main.CONTROLS['player'][direction]
+        events.setdefault(tick, []).append(pg.event.Event(pg.KEYDOWN if pressed else pg.KEYUP, key=key))
+    return events
+
+
+def run_ticks(screen, ticks, script=DEFAULT_SCRIPT, period=SCRIPT_PERIOD):
+    events = script_events(script)
+    timings = {name: 0 for name, phase in screen.phases}
+    start = time.perf_counter()
+    for tick in range(ticks):
+        for event in events.get(tick % period if period else tick, []):
+            screen.check_event(event)
+        for name, phase in screen.phases:
+            phase_start = time.perf_counter()
+            phase()
+            timings[name] += time.perf_counter() - phase_start
+    total = time.perf_counter() - start
+    return {'ticks': ticks, 'seconds': total, 'ticks_per_second': ticks / total,
+            'phase_ms_per_tick': {name: 1000 * t / ticks for name, t in timings.items()},
+            'final_state': [screen.player.x, screen.player.y]}
+
+
+def report(results, baseline=None):
+    print(f"{results['ticks']} ticks in {results['seconds']:.3f}s -> {results['ticks_per_second']:.0f} ticks/s")
+    for name, ms in results['phase_ms_per_tick'].items():
+        line = f"  {name:<12}{ms*1000:9.1f} us/tick"
+        if baseline is not None and baseline['phase_ms_per_tick'].get(name):
+            line += f"  ({100*(ms/baseline['phase_ms_per_tick'][name] - 1):+.1f}% vs baseline)"
+        print(line)
+    if baseline is not None:
+        print(f"  {'total':<12}{100*(baseline['ticks_per_second']/results['ticks_per_second'] - 1):+.1f}% time "
+              f"per tick vs baseline")
+        if results['final_state'] != baseline['final_state']:
+            print(f"  final state differs from baseline: {results['final_state']} != {baseline['final_state']}")
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='Run the game simulation without a window and time it.')
+    parser.add_argument('--ticks', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--streamed', action='store_true', help='run on the streamed world instead of the level')
+    parser.add_argument('--script', help='json file with {"events": [[tick, direction, pressed], ...], "period": n}')
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--baseline', help='compare against results saved with --save')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='exit with status 1 if time per tick grew by more than this fraction')
+    args = parser.parse_args()
+
+    controller, screen = create_game(args.seed, args.streamed)
+    script, period = load_script(args.script)
+    results = run_ticks(screen, args.ticks, script, period)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    pg.quit()
+    if baseline is not None and baseline['ticks_per_second'] / results['ticks_per_second'] - 1 > args.tolerance:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
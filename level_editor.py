@@ -1,6 +1,10 @@
 import os
 import json
+import argparse
+from collections import deque
 from pg_funcs import *
+from level_format import load_level, write_level, TileRow
+from profiler import FrameProfiler
 
 GAME_CAPTION = "Level Editor for Pygame"
 UNSCALED_SIZE = (480, 272)
@@ -15,6 +19,264 @@ SX = SCALED_SIZE[0]/UNSCALED_SIZE[0]
 SY = SCALED_SIZE[1]/UNSCALED_SIZE[1]
 
 
+class EditorMap:
+    """Sparse tile store whose edges move by shifting an origin, so resizing only touches the edge"""
+
+    def __init__(self, tiles):
+        self.cells = {}  # stored (row, col) -> tile id, empty cells are left out
+        self.origin = [0, 0]  # stored coordinates of logical (0, 0)
+        self.height = len(tiles)
+        self.width = len(tiles[0]) if tiles else 0
+        for row_count, row in enumerate(tiles):
+            for tile_count, tile in enumerate(row):
+                if tile != -1:
+                    self.cells[(row_count, tile_count)] = tile
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.height
+        if not 0 <= row < self.height:
+            raise IndexError('tile row out of range')
+        return TileRow(self, row)
+
+    def get(self, row, col):
+        return self.cells.get((row + self.origin[0], col + self.origin[1]), -1)
+
+    def set(self, row, col, tile):
+        key = (row + self.origin[0], col + self.origin[1])
+        old = self.cells.pop(key, -1)
+        if tile != -1:
+            self.cells[key] = tile
+        return old
+
+    def edge(self, direction):
+        if direction in ['left', 'right']:
+            col = 0 if direction == 'left' else self.width - 1
+            return [(row, col) for row in range(self.height)]
+        row = 0 if direction == 'up' else self.height - 1
+        return [(row, col) for col in range(self.width)]
+
+    def grow(self, direction):
+        if direction == 'left':
+            self.origin[1] -= 1
+        elif direction == 'up':
+            self.origin[0] -= 1
+        if direction in ['left', 'right']:
+            self.width += 1
+        else:
+            self.height += 1
+
+    def shrink(self, direction):
+        """Drop one edge and return its non-empty cells as (position along the edge, tile)"""
+        removed = []
+        for index, (row, col) in enumerate(self.edge(direction)):
+            tile = self.set(row, col, -1)
+            if tile != -1:
+                removed.append((index, tile))
+        if direction == 'left':
+            self.origin[1] += 1
+        elif direction == 'up':
+            self.origin[0] += 1
+        if direction in ['left', 'right']:
+            self.width -= 1
+        else:
+            self.height -= 1
+        return removed
+
+    def restore_edge(self, direction, removed):
+        self.grow(direction)
+        edge = self.edge(direction)
+        for index, tile in removed:
+            self.set(*edge[index], tile)
+
+    def swap_cells(self, cells, origin):
+        old = self.cells, self.origin
+        self.cells, self.origin = cells, origin
+        return old
+
+    def to_list(self):
+        return [[self.get(row, col) for col in range(self.width)] for row in range(self.height)]
+
+
+class EditJournal:
+    """Undo/redo history of map deltas, trimmed from the oldest end once it holds more than max_cells cells"""
+
+    def __init__(self, max_cells=1000000):
+        self.max_cells = max_cells
+        self.undo_stack = deque()
+        self.redo_stack = []
+        self.cells = 0
+        self.stroke = None
+
+    @staticmethod
+    def cost(entry):
+        kind, data = entry[0], entry[-1]
+        return 1 + (len(data[0]) if kind == 'reset' else len(data))
+
+    def record(self, entry):
+        if self.stroke:
+            # close an open stroke first so entries stay in the order they happened
+            stroke, self.stroke = self.stroke, {}
+            self.push(['set', stroke])
+        self.push(entry)
+
+    def push(self, entry):
+        # entries are (entry, cost) with the cost taken once here, since undo and redo swap entry payloads in place
+        for undone, cost in self.redo_stack:
+            self.cells -= cost
+        self.redo_stack = []
+        cost = self.cost(entry)
+        self.undo_stack.append((entry, cost))
+        self.cells += cost
+        while self.cells > self.max_cells and len(self.undo_stack) > 1:
+            self.cells -= self.undo_stack.popleft()[1]
+
+    def begin_stroke(self):
+        self.stroke = {}
+
+    def add_change(self, row, col, old, new):
+        # one stroke keeps the first old value and the last new value per cell
+        if self.stroke is None:
+            self.push(['set', {(row, col): (old, new)}])
+        elif (row, col) in self.stroke:
+            self.stroke[(row, col)] = (self.stroke[(row, col)][0], new)
+        else:
+            self.stroke[(row, col)] = (old, new)
+
+    def end_stroke(self):
+        if self.stroke:
+            self.push(['set', self.stroke])
+        self.stroke = None
+
+    def undo(self):
+        if not self.undo_stack:
+            return None
+        item = self.undo_stack.pop()
+        self.redo_stack.append(item)
+        return item[0]
+
+    def redo(self):
+        if not self.redo_stack:
+            return None
+        item = self.redo_stack.pop()
+        self.undo_stack.append(item)
+        return item[0]
+
+
+class EditorCanvas:
+    def __init__(self, screen, size):
+        self.screen = screen
+        self.surface = pg.Surface(size)
+        self.offset = None  # whole pixel map offset the surface currently shows
+        self.labels = {}
+        self.dirty_tiles = set()
+        self.tile_draws = {}  # (row, col) -> surfaces drawn for that tile, kept while the camera moves
+        self.tile_margin = 8  # tiles around the view whose draws are kept when the cache is pruned
+        size = screen.tile_size
+        # blitted rather than drawn, since draw.rect outlines the clipped part of a rect on partial redraws
+        self.empty_tile = pg.Surface((size, size), pg.SRCALPHA)
+        pg.draw.rect(self.empty_tile, (204, 255, 255), pg.Rect(0, 0, size, size), width=1)
+
+    def invalidate(self):
+        self.offset = None
+        self.tile_draws = {}
+
+    def invalidate_tile(self, row, col):
+        # addons of the neighbours depend on this tile as well
+        for y, x in [(0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)]:
+            self.dirty_tiles.add((row + y, col + x))
+            self.tile_draws.pop((row + y, col + x), None)
+
+    def get_tile_draws(self, row_count, tile_count):
+        surfaces = self.tile_draws.get((row_count, tile_count))
+        if surfaces is None:
+            tile = self.screen.map[row_count][tile_count]
+            if tile == -1:
+                surfaces = [self.empty_tile]
+            else:
+                surfaces = [self.screen.tiles[tile]] + self.screen.get_tile_addons(row_count, tile_count, tile)
+            self.tile_draws[(row_count, tile_count)] = surfaces
+        return surfaces
+
+    def get_label(self, number):
+        label = self.labels.get(number)
+        if label is None:
+            label = FONTS['SMALL'].render(f"{number}", 0, (0, 0, 0))
+            self.labels[number] = label
+        return label
+
+    def update(self, map_offset):
+        offset = (int(map_offset[0]), int(map_offset[1]))
+        w, h = self.surface.get_size()
+        if self.offset is None or abs(offset[0] - self.offset[0]) >= w or abs(offset[1] - self.offset[1]) >= h:
+            self.offset = offset
+            self.redraw(self.surface.get_rect())
+        elif offset != self.offset:
+            dx, dy = self.offset[0] - offset[0], self.offset[1] - offset[1]
+            self.offset = offset
+            self.surface.scroll(dx, dy)
+            if dx:
+                self.redraw(pg.Rect(0 if dx > 0 else w + dx, 0, abs(dx), h))
+            if dy:
+                self.redraw(pg.Rect(0, 0 if dy > 0 else h + dy, w, abs(dy)))
+        size = self.screen.tile_size
+        for row, col in self.dirty_tiles:
+            self.redraw(pg.Rect(col*size - offset[0], row*size - offset[1], size, size))
+        self.dirty_tiles.clear()
+        self.prune_tile_draws()
+
+    def prune_tile_draws(self):
+        # only cells near the view are kept, so panning across a big map does not grow the cache
+        size, margin = self.screen.tile_size, self.tile_margin
+        w, h = self.surface.get_size()
+        first_row, first_col = self.offset[1]//size - margin, self.offset[0]//size - margin
+        last_row, last_col = (self.offset[1] + h)//size + margin, (self.offset[0] + w)//size + margin
+        if len(self.tile_draws) <= 2*(last_row - first_row + 1)*(last_col - first_col + 1):
+            return
+        self.tile_draws = {(row, col): surfaces for (row, col), surfaces in self.tile_draws.items()
+                           if first_row <= row <= last_row and first_col <= col <= last_col}
+
+    def redraw(self, rect):
+        screen = self.screen
+        size = screen.tile_size
+        tile_map = screen.map
+        rect = rect.clip(self.surface.get_rect())
+        if not rect.w or not rect.h:
+            return
+        self.surface.set_clip(rect)
+        self.surface.fill((224, 224, 224), rect)
+        off_x, off_y = self.offset
+        first_row = max(0, (rect.top + off_y)//size)
+        last_row = min(len(tile_map) - 1, (rect.bottom - 1 + off_y)//size)
+        first_col = max(0, (rect.left + off_x)//size)
+        last_col = min(len(tile_map[0]) - 1 if tile_map else -1, (rect.right - 1 + off_x)//size)
+        draw_list = []
+        # row and column labels sit one tile outside the map and can overhang their tile slightly
+        if (rect.left + off_x)//size <= 0 <= (rect.right - 1 + off_x)//size + 2:
+            for row_count in range(max(0, first_row - 1), min(len(tile_map), last_row + 2)):
+                draw_list.append(self.centre_label(row_count, (-off_x - 8, row_count*size - off_y + 8)))
+        if (rect.top + off_y)//size <= 0 <= (rect.bottom - 1 + off_y)//size + 2:
+            for tile_count in range(max(0, first_col - 1), min(len(tile_map[0]) if tile_map else 0, last_col + 2)):
+                draw_list.append(self.centre_label(tile_count, (tile_count*size - off_x + 8, -off_y - 8)))
+        for row_count in range(first_row, last_row + 1):
+            y = row_count*size - off_y
+            for tile_count in range(first_col, last_col + 1):
+                pos = (tile_count*size - off_x, y)
+                for surface in self.get_tile_draws(row_count, tile_count):
+                    draw_list.append((surface, pos))
+        blit_list(self.surface, draw_list)
+        self.surface.set_clip(None)
+
+    def centre_label(self, number, centre_pos):
+        label = self.get_label(number)
+        text_width, text_height = label.get_size()
+        # whole pixel positions, so labels drawn before and after a scroll line up
+        return label, (centre_pos[0] - (text_width + 1)//2, centre_pos[1] - (text_height + 1)//2)
+
+
 class Screen:
     def __init__(self):
         self.zoom = 10
@@ -33,38 +295,56 @@ class Screen:
         self.prev_mouse_pos = pg.mouse.get_pos()
         self.mouse_pos = self.prev_mouse_pos
         self.map_path = "static/levels/first.json"
-        with open(self.map_path, 'r') as f:
-            self.map = json.load(f)
+        with load_level(self.map_path) as grid:
+            self.map = EditorMap(grid.to_list())
+        self.journal = EditJournal()
+        self.canvas = EditorCanvas(self, UNSCALED_SIZE)
+        self.changed = True
 
     def save_level(self):
+        tiles = self.map.to_list()
         with open(self.map_path, 'w') as f:
-            json.dump(self.map, f)
+            json.dump(tiles, f)
+        write_level(os.path.splitext(self.map_path)[0] + '.lvl', {'tiles': tiles})
         print('saved map :)')
 
     def reset_level(self):
-        self.map = [[-1 for x in range(len(self.map[0]))] for _ in range(len(self.map))]
+        # the old cells move into the journal instead of being copied
+        self.journal.record(['reset', self.map.swap_cells({}, [0, 0])])
+        self.canvas.invalidate()
 
     def expand_map(self, direction):
+        self.canvas.invalidate()
         if not self.expand_modifier:
-            if direction == 'left':
-                self.map = [[-1 if x == 0 else self.map[_][x-1] for x in range(len(self.map[0])+1)] for _ in range(len(self.map))]
-            elif direction == 'right':
-                self.map = [[-1 if x == len(self.map[0]) else self.map[_][x] for x in range(len(self.map[0])+1)] for _ in range(len(self.map))]
-            elif direction == 'down':
-                self.map = [[self.map[_][x] for x in range(len(self.map[0]))] if _ != len(self.map) else [-1]*len(self.map[0]) for _ in range(len(self.map)+1)]
-            else:
-                self.map = [[self.map[_-1][x] for x in range(len(self.map[0]))] if _ != 0 else [-1]*len(self.map[0]) for _ in range(len(self.map)+1)]
+            self.map.grow(direction)
+            self.journal.record(['grow', direction, []])
+        elif (self.map.width if direction in ['left', 'right'] else self.map.height) > 1:
+            self.journal.record(['shrink', direction, self.map.shrink(direction)])
+
+    def apply_entry(self, entry, undo):
+        kind = entry[0]
+        if kind == 'set':
+            for (row, col), (old, new) in entry[1].items():
+                self.map.set(row, col, old if undo else new)
+                self.canvas.invalidate_tile(row, col)
+            return
+        if kind == 'reset':
+            entry[1] = self.map.swap_cells(*entry[1])
+        elif (kind == 'grow') == undo:
+            entry[2][:] = self.map.shrink(entry[1])
         else:
-            if direction == 'left':
-                self.map = [[self.map[_][x] for x in range(1, len(self.map[0]))] for _ in
-                            range(len(self.map))]
-            elif direction == 'right':
-                self.map = [[self.map[_][x] for x in range(len(self.map[0])-1)] for _ in
-                            range(len(self.map))]
-            elif direction == 'down':
-                self.map = self.map[:-1]
-            else:
-                self.map = self.map[1:]
+            self.map.restore_edge(entry[1], entry[2])
+        self.canvas.invalidate()
+
+    def undo(self):
+        entry = self.journal.undo()
+        if entry is not None:
+            self.apply_entry(entry, True)
+
+    def redo(self):
+        entry = self.journal.redo()
+        if entry is not None:
+            self.apply_entry(entry, False)
 
     def outline_tile(self, index):
         if index == self.selected_index:
@@ -77,51 +357,42 @@ class Screen:
         if self.selected_tile is not None:
             pg.draw.rect(self.ui, (255, 255, 255), self.selected_tile)
         for index, image in enumerate(self.tiles):
-            self.ui.blit(image.copy(), (17*(SX/2), (30 * index + 20 + self.scroll)*(SX/2)))
+            self.ui.blit(image, (17*(SX/2), (30 * index + 20 + self.scroll)*(SX/2)))
+
+    def get_tile_addons(self, row_count, tile_count, tile):
+        addons = []
+        if 0 <= tile <= len(self.tile_paths)-1:
+            if self.tile_paths[tile] in self.tile_addons.keys():
+                textures = self.tile_addons[self.tile_paths[tile]]
+                for t, x, y in zip([0,1,2,3], [0, 1, -1, 0], [-1, 0, 0, 1]):
+                    if 0 <= tile_count + x < len(self.map[row_count]):
+                        try:
+                            if self.map[row_count+y][tile_count+x] != 1:
+                                addons.append(textures[t])
+                        except IndexError:
+                            addons.append(textures[t])
+        return addons
 
     def blit_map(self):
-        for row_count, row in enumerate(self.map):
-            for tile_count, tile in enumerate(row):
-                if tile_count == 0:
-                    text = centred_text(f"{row_count}", FONTS['SMALL'],
-                                        (tile_count * self.tile_size - self.map_offset[0] - 8,
-                                         row_count * self.tile_size - self.map_offset[1] + 8), (0, 0, 0))
-                    blit_text_object(self.window, text)
-                if row_count == 0:
-                    text = centred_text(f"{tile_count}", FONTS['SMALL'],
-                                        (tile_count * self.tile_size - self.map_offset[0] + 8,
-                                         - self.map_offset[1] - 8), (0, 0, 0))
-                    blit_text_object(self.window, text)
-                if tile == -1:
-                    r = pg.Rect(tile_count*self.tile_size - self.map_offset[0],
-                                row_count*self.tile_size - self.map_offset[1],
-                                self.tile_size, self.tile_size)
-                    pg.draw.rect(self.window, (204, 255, 255), r, width=1)
-                else:
-                    self.window.blit(self.tiles[tile].copy(), (tile_count*self.tile_size - self.map_offset[0],
-                                     row_count*self.tile_size - self.map_offset[1]))
-                    if 0 <= tile <= len(self.tile_paths)-1:
-                        if self.tile_paths[tile] in self.tile_addons.keys():
-                            addons = self.tile_addons[self.tile_paths[tile]]
-                            for t, x, y in zip([0,1,2,3], [0, 1, -1, 0], [-1, 0, 0, 1]):
-                                if 0 <= tile_count + x < len(row):
-                                    try:
-                                        if self.map[row_count+y][tile_count+x] != 1:
-                                            self.window.blit(addons[t].copy(), (tile_count * self.tile_size - self.map_offset[0],
-                                                            row_count * self.tile_size - self.map_offset[1]))
-                                    except:
-                                        self.window.blit(addons[t].copy(),
-                                                         (tile_count * self.tile_size - self.map_offset[0],
-                                                          row_count * self.tile_size - self.map_offset[1]))
+        self.canvas.update(self.map_offset)
+        self.window.blit(self.canvas.surface, (0, 0))
 
     def run(self):
+        """Update and draw the editor, returning False when nothing changed since the last frame"""
+        if not self.changed and self.mouse_pos == self.prev_mouse_pos:
+            return False
+        self.changed = False
         if self.scroll > 0:
             self.scroll = 0
         if self.placing_blocks:
-            if - self.map_offset[0] < self.mouse_pos[0] < - self.map_offset[0] + self.tile_size * len(self.map[0]) and \
-                    - self.map_offset[1] < self.mouse_pos[1] < - self.map_offset[1] + self.tile_size * len(self.map):
-                self.map[int((self.mouse_pos[1] + self.map_offset[1]) // self.tile_size)][int(
-                    (self.mouse_pos[0] + self.map_offset[0]) // self.tile_size)] = self.selected_index
+            if - self.map_offset[0] < self.mouse_pos[0] < - self.map_offset[0] + self.tile_size * self.map.width and \
+                    - self.map_offset[1] < self.mouse_pos[1] < - self.map_offset[1] + self.tile_size * self.map.height:
+                row = int((self.mouse_pos[1] + self.map_offset[1]) // self.tile_size)
+                col = int((self.mouse_pos[0] + self.map_offset[0]) // self.tile_size)
+                if self.map.get(row, col) != self.selected_index:
+                    old = self.map.set(row, col, self.selected_index)
+                    self.journal.add_change(row, col, old, self.selected_index)
+                    self.canvas.invalidate_tile(row, col)
 
         if self.map_move:
             for x in [0, 1]:
@@ -129,15 +400,17 @@ class Screen:
         self.draw()
         self.prev_mouse_pos = self.mouse_pos
         if self.mouse_pos[0] > 50 and self.selected_tile is not None:
-            if - self.map_offset[0] < self.mouse_pos[0] < - self.map_offset[0] + self.tile_size*len(self.map[0]) and \
-                    - self.map_offset[1] < self.mouse_pos[1] < - self.map_offset[1] + self.tile_size*len(self.map):
-                self.window.blit(self.tiles[self.selected_index].copy(),
+            if - self.map_offset[0] < self.mouse_pos[0] < - self.map_offset[0] + self.tile_size*self.map.width and \
+                    - self.map_offset[1] < self.mouse_pos[1] < - self.map_offset[1] + self.tile_size*self.map.height:
+                self.window.blit(self.tiles[self.selected_index],
                                  (self.tile_size*((self.mouse_pos[0] + self.map_offset[0])//self.tile_size) - self.map_offset[0],
                                   self.tile_size*((self.mouse_pos[1] + self.map_offset[1])//self.tile_size) - self.map_offset[1]))
             else:
-                self.window.blit(self.tiles[self.selected_index].copy(), (self.mouse_pos[0]-8, self.mouse_pos[1]-8))
+                self.window.blit(self.tiles[self.selected_index], (self.mouse_pos[0]-8, self.mouse_pos[1]-8))
+        return True
 
     def check_event(self, event):
+        self.changed = True
         if event.type == pg.MOUSEBUTTONDOWN:
             if event.button == SCROLL_UP:
                 if self.mouse_pos[0] < 50:
@@ -154,6 +427,7 @@ class Screen:
                 if self.mouse_pos[0] > 50:
                     self.map_move = True
             elif event.button == MOUSE_LEFT:
+                self.journal.begin_stroke()
                 if self.selected_tile is not None:
                     self.placing_blocks = True
                 else:
@@ -165,6 +439,7 @@ class Screen:
                     self.map_move = False
             elif event.button == MOUSE_LEFT:
                 self.placing_blocks = False
+                self.journal.end_stroke()
                 if self.mouse_pos[0] < 50:
                     for y in range(len(self.tiles)):
                         if 17 < self.mouse_pos[0] < 33 and 30*y+20-self.scroll < self.mouse_pos[1] < 30*y+36-self.scroll:
@@ -180,6 +455,10 @@ class Screen:
                 self.save_level()
             elif event.key == pg.K_r:
                 self.reset_level()
+            elif event.key == pg.K_z and self.expand_modifier:
+                self.undo()
+            elif event.key == pg.K_y and self.expand_modifier:
+                self.redo()
             elif event.key == pg.K_LCTRL:
                 self.expand_modifier = False
             elif event.key == pg.K_LEFT:
@@ -193,40 +472,63 @@ class Screen:
 
     def draw(self):
         self.ui.fill((96, 96, 96))
-        self.window.fill((224, 224, 224))
         self.blit_map()
         self.blit_ui()
 
 
 class Controller:
-    def __init__(self):
+    def __init__(self, profile_path=None):
         self.display = pg.display.get_surface()
+        self.profiler = FrameProfiler(export_path=profile_path)
         self.game_running = True
         self.clock = pg.time.Clock()
         self.frame_rate = 60
         self.screen = Screen()
+        self.presenter = Presenter(self.display)
+        self.presenter.add_layer(self.screen.window, SCALED_SIZE)
+        self.presenter.add_layer(self.screen.ui, (int(100*SX//2), SCALED_SIZE[1]))
+        self.overlay_rect = None
 
     def get_events(self):
         for event in pg.event.get():
             if event.type == pg.QUIT:
                 self.game_running = False
+            elif event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                self.profiler.toggle()
             else:
                 self.screen.check_event(event)
 
     def main_loop(self):
+        profiler = self.profiler
         while self.game_running:
-            self.clock.tick(self.frame_rate)
+            profiler.begin_frame()
+            with profiler.scope('wait'):
+                self.clock.tick(self.frame_rate)
             x,y = pg.mouse.get_pos()
             self.screen.mouse_pos = (x/SX, y/SY)
-            self.get_events()
-            self.screen.run()
-            self.display.blit(pg.transform.scale(self.screen.window, (SCALED_SIZE[0], SCALED_SIZE[1])), (0, 0))
-            self.display.blit(pg.transform.scale(self.screen.ui, (int(100*SX//2), SCALED_SIZE[1])), (0, 0))
-            pg.display.update()
+            with profiler.scope('events'):
+                self.get_events()
+            with profiler.scope('run'):
+                if self.screen.run():
+                    self.presenter.mark_all()
+            with profiler.scope('scale'):
+                if self.overlay_rect is not None:
+                    self.presenter.mark_display(self.overlay_rect)
+                self.presenter.present()
+                self.overlay_rect = self.profiler.draw(self.display)
+                if self.overlay_rect is not None:
+                    self.presenter.add_rect(self.overlay_rect)
+            with profiler.scope('update'):
+                self.presenter.update()
+            profiler.end_frame()
+        profiler.close()
         pg.quit()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=GAME_CAPTION)
+    parser.add_argument('--profile', help='write per-frame timings to this .csv or .jsonl file (F3 shows them)')
+    args = parser.parse_args()
     os.environ["SDL_VIDEO_CENTERED"] = "True"
     pg.display.init()
     pg.font.init()
@@ -237,6 +539,9 @@ if __name__ == '__main__':
     display_info = pg.display.Info()
     SCREEN_SIZE = (display_info.current_w, display_info.current_h)
     pg.display.set_mode(SCALED_SIZE)
-    Controller().main_loop()
+    preload_assets(['tiles'])
+    controller = Controller(args.profile)
+    save_asset_cache()
+    controller.main_loop()
 
 
@@ -0,0 +1,304 @@
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+
+# header: magic, version, chunk size, width, height, layer count, reserved
+HEADER = struct.Struct('<4sHHIIHH')
+LAYER_NAME = struct.Struct('<16s')
+MAGIC = b'PLVL'
+VERSION = 1
+EMPTY_TILE = -1
+TILE_TYPE = 'h'  # int16 tile ids, little endian on disk
+
+
+class LevelFile:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.chunk_size, self.width, self.height, layer_count, _ = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} level file")
+        offset = HEADER.size
+        self.layers = []
+        for _ in range(layer_count):
+            self.layers.append(LAYER_NAME.unpack_from(self.data, offset)[0].rstrip(b'\0').decode())
+            offset += LAYER_NAME.size
+        self.chunks_x = -(-self.width // self.chunk_size)
+        self.chunks_y = -(-self.height // self.chunk_size)
+        # one uint64 data offset per (layer, chunk row, chunk column); 0 marks an empty chunk
+        count = layer_count * self.chunks_x * self.chunks_y
+        self.directory = memoryview(self.data)[offset:offset + 8*count].cast('Q')
+
+    def read_chunk(self, cx, cy, layer=0):
+        if isinstance(layer, str):
+            layer = self.layers.index(layer)
+        size = self.chunk_size
+        offset = self.directory[(layer*self.chunks_y + cy)*self.chunks_x + cx]
+        if not offset:
+            return [[EMPTY_TILE]*size for _ in range(size)]
+        tiles = array(TILE_TYPE)
+        tiles.frombytes(self.data[offset:offset + 2*size*size])
+        if sys.byteorder != 'little':
+            tiles.byteswap()
+        tiles = tiles.tolist()
+        return [tiles[row*size:(row + 1)*size] for row in range(size)]
+
+    def has_chunk(self, cx, cy, layer=0):
+        if isinstance(layer, str):
+            layer = self.layers.index(layer)
+        return self.directory[(layer*self.chunks_y + cy)*self.chunks_x + cx] != 0
+
+    def close(self):
+        self.directory.release()
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TileGrid:
+    """Row-indexable view of one level layer that loads chunks from the file on first touch"""
+
+    def __init__(self, level, layer=0):
+        self.level = level
+        self.layer = layer
+        self.width = level.width
+        self.height = level.height
+        self.chunk_size = level.chunk_size
+        self.chunks = {}
+        self.rows = [TileRow(self, row) for row in range(self.height)]
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            return self.rows[row]
+        if row < 0:
+            row += self.height
+        if not 0 <= row < self.height:
+            raise IndexError('tile row out of range')
+        return self.rows[row]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def get_chunk(self, cx, cy):
+        chunk = self.chunks.get((cx, cy))
+        if chunk is None:
+            chunk = self.level.read_chunk(cx, cy, self.layer)
+            self.chunks[(cx, cy)] = chunk
+        return chunk
+
+    def get(self, row, col):
+        size = self.chunk_size
+        return self.get_chunk(col // size, row // size)[row % size][col % size]
+
+    def set(self, row, col, tile):
+        size = self.chunk_size
+        self.get_chunk(col // size, row // size)[row % size][col % size] = tile
+
+    def to_list(self):
+        return [list(row) for row in self.rows]
+
+    def close(self):
+        self.level.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TileRow:
+    __slots__ = ['grid', 'row']
+
+    def __init__(self, grid, row):
+        self.grid = grid
+        self.row = row
+
+    def __len__(self):
+        return self.grid.width
+
+    def __getitem__(self, col):
+        if isinstance(col, slice):
+            return [self.grid.get(self.row, x) for x in range(*col.indices(self.grid.width))]
+        if col < 0:
+            col += self.grid.width
+        if not 0 <= col < self.grid.width:
+            raise IndexError('tile column out of range')
+        return self.grid.get(self.row, col)
+
+    def __setitem__(self, col, tile):
+        if col < 0:
+            col += self.grid.width
+        if not 0 <= col < self.grid.width:
+            raise IndexError('tile column out of range')
+        self.grid.set(self.row, col, tile)
+
+    def __iter__(self):
+        for col in range(self.grid.width):
+            yield self.grid.get(self.row, col)
+
+
+def write_level(path, layers, chunk_size=16):
+    """Write {layer name: 2D list of tile ids} to the chunked binary format"""
+    names = list(layers)
+    sizes = {name: (len(layers[name]), max((len(row) for row in layers[name]), default=0)) for name in names}
+    height, width = sizes[names[0]]
+    for name in names[1:]:
+        if sizes[name] != (height, width):
+            raise ValueError(f"layer {name!r} is {sizes[name][1]}x{sizes[name][0]} tiles, "
+                             f"but {names[0]!r} is {width}x{height}; every layer must be the same size")
+    chunks_x = -(-width // chunk_size)
+    chunks_y = -(-height // chunk_size)
+    directory = array('Q', [0]*(len(names)*chunks_x*chunks_y))
+    offset = HEADER.size + LAYER_NAME.size*len(names) + 8*len(directory)
+    blobs = []
+    for layer, name in enumerate(names):
+        grid = layers[name]
+        for cy in range(chunks_y):
+            for cx in range(chunks_x):
+                tiles = array(TILE_TYPE)
+                for row in range(cy*chunk_size, (cy + 1)*chunk_size):
+                    line = grid[row] if row < height else []
+                    line = line[cx*chunk_size:(cx + 1)*chunk_size]
+                    tiles.extend(line)
+                    tiles.extend([EMPTY_TILE]*(chunk_size - len(line)))
+                if any(tile != EMPTY_TILE for tile in tiles):
+                    if sys.byteorder != 'little':
+                        tiles.byteswap()
+                    directory[(layer*chunks_y + cy)*chunks_x + cx] = offset
+                    blobs.append(tiles.tobytes())
+                    offset += len(blobs[-1])
+    if sys.byteorder != 'little':
+        directory.byteswap()
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, chunk_size, width, height, len(names), 0))
+        for name in names:
+            f.write(LAYER_NAME.pack(name.encode()))
+        f.write(directory.tobytes())
+        for blob in blobs:
+            f.write(blob)
+
+
+def convert_json(json_path, out_path=None, chunk_size=16):
+    if out_path is None:
+        out_path = os.path.splitext(json_path)[0] + '.lvl'
+    with open(json_path, 'r') as f:
+        tiles = json.load(f)
+    write_level(out_path, {'tiles': tiles}, chunk_size)
+    return out_path
+
+
+def load_level(path):
+    """Open a level as a lazily loaded TileGrid, rebuilding the .lvl file when its json source is newer"""
+    root, ext = os.path.splitext(path)
+    if ext == '.json':
+        binary_path = root + '.lvl'
+        if not os.path.isfile(binary_path) or os.path.getmtime(binary_path) < os.path.getmtime(path):
+            convert_json(path, binary_path)
+        path = binary_path
+    return TileGrid(LevelFile(path))
+
+
+def find_regions(grid, tile):
+    """Connected regions of one tile id, each with its bounds and the spans of its top surface"""
+    level = grid.level
+    size = grid.chunk_size
+    width, height = grid.width, grid.height
+    chunks = {}
+
+    def chunk(cx, cy):
+        if (cx, cy) not in chunks:
+            # edited chunks come from the grid, the rest are read without the grid keeping them
+            chunks[(cx, cy)] = grid.chunks.get((cx, cy)) or level.read_chunk(cx, cy, grid.layer)
+        return chunks[(cx, cy)]
+
+    def get(row, col):
+        return chunk(col // size, row // size)[row % size][col % size]
+
+    labels = {}
+    regions = []
+    for cy in range(level.chunks_y):
+        for cx in range(level.chunks_x):
+            if tile != EMPTY_TILE and (cx, cy) not in grid.chunks and not level.has_chunk(cx, cy, grid.layer):
+                continue
+            block = chunk(cx, cy)
+            for start in ((row, col) for row in range(cy*size, min((cy + 1)*size, height))
+                          for col in range(cx*size, min((cx + 1)*size, width))
+                          if block[row - cy*size][col - cx*size] == tile):
+                if start in labels:
+                    continue
+                label = labels[start] = len(regions)
+                top = bottom = start[0]
+                left = right = start[1]
+                count = 0
+                surface = []
+                stack = [start]
+                while stack:
+                    row, col = cell = stack.pop()
+                    count += 1
+                    if row < top:
+                        top = row
+                    elif row > bottom:
+                        bottom = row
+                    if col < left:
+                        left = col
+                    elif col > right:
+                        right = col
+                    if row == 0 or get(row - 1, col) != tile:
+                        surface.append(cell)
+                    for neighbour, inside in (((row - 1, col), row > 0), ((row + 1, col), row < height - 1),
+                                              ((row, col - 1), col > 0), ((row, col + 1), col < width - 1)):
+                        if inside and neighbour not in labels and get(*neighbour) == tile:
+                            labels[neighbour] = label
+                            stack.append(neighbour)
+                # surface spans are runs of region tiles with no region tile above them
+                surface.sort()
+                spans = []
+                for row, col in surface:
+                    if spans and spans[-1][0] == row and spans[-1][2] == col - 1:
+                        spans[-1][2] = col
+                    else:
+                        spans.append([row, col, col])
+                # the first surface tile is the region's first tile in reading order
+                regions.append((surface[0], {'top': top, 'bottom': bottom, 'left': left, 'right': right,
+                                             'size': count, 'surfaces': spans}))
+    # numbered in reading order of their first tile, the same whichever chunk found them
+    return [region for first, region in sorted(regions, key=lambda item: item[0])]
+
+
+def load_regions(grid, tile):
+    """find_regions for a level opened with load_level, cached in a sidecar file keyed by its size and mtime"""
+    path = os.path.splitext(grid.level.path)[0] + '.regions.json'
+    stat = os.stat(grid.level.path)
+    digest = f"{stat.st_size}:{stat.st_mtime_ns}"
+    cache = {'source': digest, 'tiles': {}}
+    if os.path.isfile(path):
+        with open(path, 'r') as f:
+            try:
+                stored = json.load(f)
+            except ValueError:
+                stored = {}
+        if stored.get('source') == digest:
+            cache = stored
+    if str(tile) not in cache['tiles']:
+        cache['tiles'][str(tile)] = find_regions(grid, tile)
+        with open(path, 'w') as f:
+            json.dump(cache, f)
+    return cache['tiles'][str(tile)]
+
+
+if __name__ == '__main__':
+    for level_path in sys.argv[1:]:
+        print(f"{level_path} -> {convert_json(level_path)}")
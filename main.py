@@ -1,6 +1,12 @@
 import os
+import struct
+import argparse
+from array import array
+from collections import deque
 from pg_classes import *
 from physics import *
+from profiler import FrameProfiler
+from replay import ReplayRecorder, seed_arg
 import time
 # GLOBALS
 GAME_CAPTION = "Platformer"
@@ -12,6 +18,8 @@ CONTROLS = {'player': {'up': pg.K_w, 'down': pg.K_s, 'left': pg.K_a, 'right': pg
 
 
 class Player(Entity):
+    PLAYER_STATE = struct.Struct('<2d7?3i')  # camera offset, moving, double jump flags, flipped, animation
+
     def __init__(self, x, y):
         super().__init__(x, y, 16, 32, "static/player/")
         self.moving = {key: False for key in ['left', 'right', 'up', 'down']}
@@ -22,6 +30,23 @@ class Player(Entity):
         self.y_middle = UNSCALED_SIZE[1]//2
         self.offset = [self.x - self.x_middle, self.y - self.y_middle]
         self.animation_dict = {key: len(value) for key, value in Entity.animations['player'].items()}
+        self.animation_names = list(self.animation_dict)
+
+    def get_state(self):
+        return super().get_state() + self.PLAYER_STATE.pack(
+            self.offset[0], self.offset[1], *self.moving.values(), self.double, self.double_waiting, self.flipped,
+            self.animation_names.index(self.animation), self.animation_timer, self.animation_index)
+
+    def set_state(self, data, offset=0):
+        offset = super().set_state(data, offset)
+        values = self.PLAYER_STATE.unpack_from(data, offset)
+        self.offset[0], self.offset[1] = values[:2]
+        for key, value in zip(self.moving, values[2:6]):
+            self.moving[key] = value
+        self.double, self.double_waiting, self.flipped = values[6:9]
+        self.animation = self.animation_names[values[9]]
+        self.animation_timer, self.animation_index = values[10:]
+        return offset + self.PLAYER_STATE.size
 
     def check_key_up(self, key):
         for d, k in zip(['up', 'down', 'left', 'right'],
@@ -84,8 +109,9 @@ class _Screen:
     def __init__(self, parent):
         self.parent = parent
 
-    def draw(self):
-        pass
+    def draw(self, alpha=1.0):
+        # returns the changed window rects, or None when the whole window was redrawn
+        return []
 
     def run(self):
         pass
@@ -93,6 +119,9 @@ class _Screen:
     def reset(self):
         pass
 
+    def invalidate(self):
+        pass
+
     def check_event(self, event):
         pass
 
@@ -105,6 +134,7 @@ class MenuScreen(_Screen):
             create_button((150, 400), (300, 100), text="Options", font=FONTS['MEDIUM']),
         ]
         self.switch_screen = ["game", "options"]
+        self.drawn = False
 
     def check_event(self, event):
         if event.type == pg.MOUSEBUTTONUP:
@@ -114,12 +144,20 @@ class MenuScreen(_Screen):
                     if button[0][0].collidepoint(x, y):
                         self.parent.screen = SCREENS[command]
 
-    def draw(self):
+    def invalidate(self):
+        self.drawn = False
+
+    def draw(self, alpha=1.0):
+        # nothing on the menu moves, so it is only drawn when it comes back on screen
+        if self.drawn:
+            return []
         window = self.parent.window
         window.fill((204, 255, 255))
         for button in self.buttons:
             window.fill(button[0][1], button[0][0])
             blit_text_object(window, button[1])
+        self.drawn = True
+        return None
 
 
 class OptionsScreen(_Screen):
@@ -133,56 +171,181 @@ class ControlsScreen(_Screen):
 
 
 class GameScreen(_Screen):
-    def __init__(self, parent):
+    SCREEN_STATE = struct.Struct('<2d?d')  # interpolation offset, gaussian random carry
+
+    def __init__(self, parent, streamed=False):
         _Screen.__init__(self, parent)
         self.player = Player(200, 0)
         self.map = Map(UNSCALED_SIZE[0], UNSCALED_SIZE[1], 16)
-        self.map_floor = len(self.map.map) * self.map.tile_size
+        self.streamed = streamed  # endless generated terrain instead of the level
+        self.map_floor = float('inf') if streamed else len(self.map.map) * self.map.tile_size
+        self.is_solid = self.map.is_streamed_solid if streamed else self.map.is_solid
         self.keys_down = []
-        self.water = []
-        self.group_water_tiles()
-        # self.cloth = Cloth(100,100,60,80)
+        self.previous_offset = list(self.player.offset)
+        self.water = None
+        self.water_regions = []
+        self.world = EntityWorld()
+        self.world.add(self.player)
+        if streamed:
+            self.water = WaterSystem([])
+        else:
+            self.group_water_tiles()
+        self.cloths = []
+        # self.cloths.append(Cloth(100,100,60,80))
+        self.particles = ParticleSystem()
+        self.debris = BodyBatch(capacity=32)
+        self.phases = [('player', self.run_player), ('collisions', self.run_collisions),
+                       ('entities', self.world.step), ('cloth', self.run_cloths), ('water', self.run_water),
+                       ('particles', self.particles.step), ('debris', self.run_debris)]
+        if streamed:
+            # ahead of collisions so the chunks a body is about to enter are already asked for
+            self.phases.insert(1, ('stream', self.run_stream))
+            self.run_stream()
+        self.quick_save = None
+        self.history = deque(maxlen=5*60)  # a snapshot per tick for rewinding up to five seconds
+        self.rewinding = False
 
     def run(self):
+        if self.rewinding:
+            if self.history:
+                self.restore(self.history.pop())
+            return
+        for name, phase in self.phases:
+            with self.parent.profiler.scope(name):
+                phase()
+        if self.can_time_travel():
+            self.history.append(self.snapshot())
+
+    def snapshot(self):
+        """Game state as (bytes, shared): shared holds references to things kept as they are rather than copied"""
+        version, internal, gauss = random.getstate()
+        data = b''.join([self.SCREEN_STATE.pack(self.previous_offset[0], self.previous_offset[1], gauss is not None,
+                                                gauss or 0),
+                         array('I', internal).tobytes(), self.player.get_state(), self.water.snapshot(),
+                         self.debris.snapshot()] +
+                        [cloth.snapshot() for cloth in self.cloths])
+        # the map is never changed by play, so it is not part of a snapshot at all
+        return data, (tuple(self.world.triggers), self.world.contacts)
+
+    def restore(self, snapshot):
+        data, (triggers, contacts) = snapshot
+        offset_x, offset_y, has_gauss, gauss = self.SCREEN_STATE.unpack_from(data, 0)
+        self.previous_offset[0], self.previous_offset[1] = offset_x, offset_y
+        offset = self.SCREEN_STATE.size
+        internal = array('I')
+        internal.frombytes(data[offset:offset + 625*internal.itemsize])
+        offset += 625*internal.itemsize
+        random.setstate((3, tuple(internal), gauss if has_gauss else None))
+        offset = self.player.set_state(data, offset)
+        offset = self.water.restore(data, offset)
+        offset = self.debris.restore(data, offset)
+        for cloth in self.cloths:
+            offset = cloth.restore(data, offset)
+        if list(triggers) != self.world.triggers:
+            # picked up triggers come back
+            for trigger in list(self.world.triggers):
+                self.world.remove(trigger)
+            for trigger in triggers:
+                trigger.alive = True
+                self.world.add(trigger)
+        self.world.contacts = contacts
+        # particles are only decoration and are not in snapshots, so ones from another moment are dropped
+        self.particles.clear()
+
+    def sync_input(self):
+        # after jumping in time the held keys are the ones on the keyboard, not the ones in the snapshot
+        pressed = pg.key.get_pressed()
+        for direction, key in CONTROLS['player'].items():
+            self.player.movement(direction, bool(pressed[key]))
+
+    def run_player(self):
+        self.previous_offset[0], self.previous_offset[1] = self.player.offset
         self.player.check_movement()
-        collision_list = []
-        collision_list.extend(self.map.get_map_collisions([self.player.x, self.player.y, self.player.w,
-                                                           self.player.h]))
-        self.player.move(collision_list)
-        if self.player.y > self.map_floor:
+
+    def run_collisions(self):
+        fall_speed = self.player.v[1]
+        was_colliding = dict(self.player.colliding)
+        contacts = self.player.sweep(self.is_solid, self.map.tile_size)
+        self.emit_contact_particles(contacts, was_colliding, fall_speed)
+        respawned = self.player.y > self.map_floor
+        if respawned:
             self.player.x = 200
             self.player.y = 0
         self.player.offset[1] = self.player.y - self.player.y_middle + 16
         self.player.offset[0] = self.player.x - self.player.x_middle + 8
-        self.cloth.update()
-        if self.water:
-            for x in self.water:
-                x.run([self.player.x, self.player.y, self.player.w, self.player.h], self.player.v[1], self.player.v[0])
+        if respawned:
+            self.previous_offset[0], self.previous_offset[1] = self.player.offset
+
+    def run_stream(self):
+        player = self.player
+        self.map.stream_chunks((player.x + player.w/2, player.y + player.h/2))
+
+    def get_view(self):
+        return (self.player.offset[0], self.player.offset[1], UNSCALED_SIZE[0], UNSCALED_SIZE[1])
+
+    def run_cloths(self):
+        view = self.get_view()
+        for cloth in self.cloths:
+            cloth.set_view(view)
+            if cloth.asleep and cloth.get_rect().colliderect(self.player.rect):
+                cloth.wake()
+            cloth.update()
+
+    def emit_contact_particles(self, contacts, was_colliding, fall_speed):
+        player = self.player
+        for (nx, ny), (row, col) in contacts:
+            if ny < 0 and not was_colliding['down'] and fall_speed > 2:
+                self.particles.emit('dust', player.x + player.w/2, player.y + player.h, int(2*fall_speed),
+                                    (0, -1), spread=1.2, life=20)
+                if fall_speed > 4 and not self.streamed:
+                    self.emit_debris(player.x + player.w/2, player.y + player.h - 4, fall_speed)
+            elif nx and not was_colliding['left' if nx > 0 else 'right']:
+                self.particles.emit('dust', player.x if nx > 0 else player.x + player.w, player.y + player.h/2, 6,
+                                    (nx, 0), spread=0.8, life=15)
+
+    def emit_debris(self, x, y, fall_speed):
+        for vx in [-1.5, -0.5, 0.5, 1.5]:
+            self.debris.add(x + 2*vx, y, 3, 3, v=(vx, -fall_speed/2), life=90)
+
+    def run_debris(self):
+        batch = self.debris
+        if not len(batch):
+            return
+        moving = batch.alive & ~batch.resting
+        solid = None
+        if moving.any():
+            ts = self.map.tile_size
+            low = batch.pos[moving].min(axis=0) - ts
+            high = (batch.pos[moving] + batch.size[moving]).max(axis=0) + ts
+            # only the level chunks around moving debris are copied into the mask, each of them once
+            solid = self.map.get_solid_mask((low[0], low[1], high[0] - low[0], high[1] - low[1]))
+        batch.step(solid, self.map.tile_size)
+        batch.vel[batch.contacts[:, 1], 0] *= 0.8
+
+    def run_water(self):
+        player = self.player
+        self.water.set_view(self.get_view())
+        hits = self.water.run([player.x, player.y, player.w, player.h], player.v[1], player.v[0])
+        for k in hits:
+            self.particles.emit('splash', player.x + player.w/2, self.water.surface[k],
+                                int(4 + 4*abs(player.v[1])), (0, -0.8*abs(player.v[1])), spread=1.0, life=30)
 
     def group_water_tiles(self):
         index = 0
-        water_list = []
-        avoid_list = []
         for ind, x in enumerate(self.map.tile_paths):
             if 'water' in x:
                 index = ind
                 break
-        for row_count, row in enumerate(self.map.map):
-            start = -1
-            for tile_count, tile in enumerate(row[:-1]):
-                if tile == index and (row_count - 1, tile_count) not in avoid_list:
-                    avoid_list.append((row_count, tile_count))
-                    if start == -1:
-                        start = tile_count
-                    if row[tile_count + 1] != index:
-                        water_list.append((start, tile_count, row_count))
-                        for x in range(start, tile_count+1):
-                            row[x] = -1
-
-                        start = -1
-        self.water = [Water((x[0]*self.map.tile_size, x[2]*self.map.tile_size + self.map.tile_size/2),
-                            (x[1]*self.map.tile_size + self.map.tile_size,
-                             x[2]*self.map.tile_size + self.map.tile_size/2)) for x in water_list]
+        ts = self.map.tile_size
+        self.water_regions = self.map.get_regions(index)
+        bodies = []
+        for region in self.water_regions:
+            for row, start, end in region['surfaces']:
+                bodies.append(Water((start*ts, row*ts + ts/2), ((end + 1)*ts, row*ts + ts/2)))
+                self.map.hide_tiles((row, x) for x in range(start, end + 1))
+            self.world.add(Volume(region['left']*ts, region['top']*ts + ts//2, (region['right'] - region['left'] + 1)*ts,
+                                  (region['bottom'] - region['top'] + 1)*ts - ts//2))
+        self.water = WaterSystem(bodies)
 
     def check_event(self, event):
         if event.type == pg.KEYDOWN:
@@ -190,49 +353,141 @@ class GameScreen(_Screen):
                 self.parent.game_running = False
             elif event.key in CONTROLS['player'].values():
                 self.player.check_key_down(event.key)
+            elif not self.can_time_travel():
+                return
+            elif event.key == pg.K_F5:
+                self.quick_save = self.snapshot()
+            elif event.key == pg.K_F9 and self.quick_save is not None:
+                self.restore(self.quick_save)
+                self.history.clear()
+                self.sync_input()
+            elif event.key == pg.K_BACKSPACE:
+                self.rewinding = True
         elif event.type == pg.KEYUP:
             if event.key in CONTROLS['player'].values():
                 self.player.check_key_up(event.key)
+            elif event.key == pg.K_BACKSPACE and self.rewinding:
+                self.rewinding = False
+                self.sync_input()
 
-    def draw(self):
+    def can_time_travel(self):
+        # a replay only holds the movement keys, so loads and rewinds would make it diverge
+        return self.parent.interactive and self.parent.recorder is None
+
+    def draw(self, alpha=1.0):
+        offset = [p + (o - p) * alpha for p, o in zip(self.previous_offset, self.player.offset)]
         self.parent.window.fill((204, 255, 255))
+        if self.streamed:
+            # streamed chunks are opaque, so they go under the player
+            x_index, y_index = int(offset[0]//self.map.x_size), int(offset[1]//self.map.y_size)
+            for yy in range(2):
+                self.map.blit_chunk(self.parent.window, x_index, y_index + yy, (-offset[0], -offset[1]))
         self.player.draw_centre(self.parent.window)
-        self.map.blit_map(self.parent.window, self.player.offset)
-        if self.water:
-            for x in self.water:
-                x.draw(self.parent.window, self.player.offset)
-        self.cloth.draw(self.parent.window)
+        if not self.streamed:
+            self.map.blit_map(self.parent.window, offset)
+        self.water.draw(self.parent.window, offset)
+        for cloth in self.cloths:
+            cloth.draw(self.parent.window, offset)
+        self.particles.draw(self.parent.window, offset)
+        for body in self.debris.bodies():
+            rect = body.rect
+            self.parent.window.fill((92, 64, 51), (rect.x - offset[0], rect.y - offset[1], rect.w, rect.h))
+        return None
 
 
 class Controller:
-    def __init__(self):
+    def __init__(self, profile_path=None, recorder=None):
         self.display = pg.display.get_surface()
         self.window = pg.Surface(UNSCALED_SIZE)
+        self.profiler = FrameProfiler(export_path=profile_path)
+        self.presenter = Presenter(self.display)
+        self.presenter.add_layer(self.window, SCALED_SIZE)
+        self.overlay_rect = None
         self.game_running = True
         self.clock = pg.time.Clock()
         self.frame_rate = 60
+        self.tick_rate = 60
+        self.max_ticks_per_frame = 5
+        self.accumulator = 0
         self.screen = None
+        self.drawn_screen = None
+        self.tick = 0
+        self.recorder = recorder
+        self.interactive = False  # set by main_loop, replays and headless runs drive the screen themselves
 
     def get_events(self):
         for event in pg.event.get():
             if event.type == pg.QUIT:
                 self.game_running = False
+            elif event.type == pg.KEYDOWN and event.key == pg.K_F3:
+                self.profiler.toggle()
             else:
+                if self.recorder is not None and event.type in [pg.KEYDOWN, pg.KEYUP]:
+                    # events are handled before the next tick runs, so they are stored against it
+                    self.recorder.record_event(self.tick, event.key, event.type == pg.KEYDOWN)
                 self.screen.check_event(event)
 
+    def present(self, rects):
+        if rects is None:
+            self.presenter.mark()
+        else:
+            for rect in rects:
+                self.presenter.mark(0, rect)
+        if self.overlay_rect is not None:
+            # the overlay is blended over the output, so what is under it has to be rescaled first
+            self.presenter.mark_display(self.overlay_rect)
+        self.presenter.present()
+        self.overlay_rect = self.profiler.draw(self.display)
+        if self.overlay_rect is not None:
+            self.presenter.add_rect(self.overlay_rect)
+
     def main_loop(self):
+        self.interactive = True
         self.screen = SCREENS['game']
+        tick_length = 1000 / self.tick_rate
+        profiler = self.profiler
         while self.game_running:
-            self.clock.tick(self.frame_rate)
-            self.get_events()
-            self.screen.run()
-            self.screen.draw()
-            self.display.blit(pg.transform.scale(self.window, SCALED_SIZE), (0, 0))
-            pg.display.update()
+            profiler.begin_frame()
+            with profiler.scope('wait'):
+                self.accumulator += self.clock.tick(self.frame_rate)
+            with profiler.scope('events'):
+                self.get_events()
+            ticks = 0
+            while self.accumulator >= tick_length and ticks < self.max_ticks_per_frame:
+                self.screen.run()
+                if self.recorder is not None:
+                    self.recorder.after_tick(self.tick, self.screen)
+                self.tick += 1
+                self.accumulator -= tick_length
+                ticks += 1
+            if ticks == self.max_ticks_per_frame:
+                # too far behind to catch up, drop the backlog instead of spiralling
+                self.accumulator = min(self.accumulator, tick_length)
+            if self.screen is not self.drawn_screen:
+                self.screen.invalidate()
+                self.drawn_screen = self.screen
+            with profiler.scope('draw'):
+                rects = self.screen.draw(self.accumulator / tick_length)
+            with profiler.scope('scale'):
+                self.present(rects)
+            with profiler.scope('update'):
+                self.presenter.update()
+            profiler.end_frame()
+        profiler.close()
+        if self.recorder is not None:
+            self.recorder.close(self.screen)
         pg.quit()
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=GAME_CAPTION)
+    parser.add_argument('--profile', help='write per-frame timings to this .csv or .jsonl file (F3 shows them)')
+    parser.add_argument('--record', help='record the input of this session to a replay file for replay.py')
+    parser.add_argument('--seed', type=seed_arg, default=0)
+    parser.add_argument('--streamed', action='store_true', help='play on endless generated terrain')
+    args = parser.parse_args()
+    if args.streamed and args.record:
+        parser.error('replays only cover the level, not the streamed world')
     os.environ["SDL_VIDEO_CENTERED"] = "True"
     pg.display.init()
     pg.font.init()
@@ -243,8 +498,12 @@ if __name__ == '__main__':
     display_info = pg.display.Info()
     SCREEN_SIZE = (display_info.current_w, display_info.current_h)
     pg.display.set_mode(SCALED_SIZE)
-    controller = Controller()
+    preload_assets(['tiles', 'player'])
+    random.seed(args.seed)
+    recorder = ReplayRecorder(args.record, CONTROLS['player'], args.seed) if args.record else None
+    controller = Controller(args.profile, recorder)
     SCREENS = {'menu': MenuScreen(controller), 'options': OptionsScreen(controller),
-               'controls': ControlsScreen(controller), 'game': GameScreen(controller)}
+               'controls': ControlsScreen(controller), 'game': GameScreen(controller, args.streamed)}
+    save_asset_cache()
     controller.main_loop()
 
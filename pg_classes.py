@@ -2,10 +2,18 @@ import pygame as pg
 import math
 import json
 import random
+import struct
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pg_funcs import *
+from level_format import load_level, load_regions
 
 
 class Physics2D:
+    obj_type = 1
+    STATE = struct.Struct('<6d5?')  # position, velocity, previous position, colliding, submerged
+
     def __init__(self, x, y, w, h, g=1):
         self.x = x
         self.y = y
@@ -13,14 +21,20 @@ class Physics2D:
         self.w = w
         self.v = [0, 0]
         self.g = g
+        self.previous = [x, y]
         self.rect = pg.Rect(x, y, w, h)
         self.vert_collisions = []
         self.hori_collisions = []
         self.colliding = {key: False for key in ['up', 'down', 'left', 'right']}
+        self.overlaps = []
+        self.submerged = False
+        self.contacts = []  # (normal, (row, col)) of the tiles hit by the last sweep
 
     def move(self, objs, obj_types=None):
-        if obj_types is None:
-            obj_types = [1] * len(objs)
+        if obj_types is not None:
+            # only walls block, anything else reaches on_overlap through EntityWorld
+            objs = [obj for obj, obj_type in zip(objs, obj_types) if obj_type == 1]
+        self.previous[0], self.previous[1] = self.x, self.y
         self.x += self.v[0]
         self.y += self.v[1]
         self.rect.x = int(self.x)
@@ -28,37 +42,65 @@ class Physics2D:
         for key in ['up', 'down', 'left', 'right']:
             self.colliding[key] = False
         self.check_collisions(objs)
-        for collide, collide_type in zip(self.hori_collisions, obj_types):
-            if collide_type == 1:
-                if self.rect.centerx < collide.centerx:
-                    self.rect.right = collide.left
-                    self.colliding['right'] = True
-                else:
-                    self.rect.left = collide.right
-                    self.colliding['left'] = True
-            elif collide_type == 2: # underwater etc
-                pass
-            elif collide_type == 0: # checking for collisions of non walls (like coins)
-                pass
-        for collide, collide_type in zip(self.vert_collisions, obj_types):
-            if collide_type == 1:
-                if self.v[1] < 0:
-                    if self.rect.bottom >= collide.bottom:
-                        self.rect.top = collide.bottom
-                        self.colliding['up'] = True
-                elif self.v[1] > 0:
-                    self.rect.bottom = collide.top
-                    self.colliding['down'] = True
-            elif collide_type == 2: # underwater etc
-                pass
-            elif collide_type == 0: # checking for collisions of non walls (like coins)
-                pass
+        for collide in self.hori_collisions:
+            if self.rect.centerx < collide.centerx:
+                self.rect.right = collide.left
+                self.colliding['right'] = True
+            else:
+                self.rect.left = collide.right
+                self.colliding['left'] = True
+        for collide in self.vert_collisions:
+            if self.v[1] < 0:
+                if self.rect.bottom >= collide.bottom:
+                    self.rect.top = collide.bottom
+                    self.colliding['up'] = True
+            elif self.v[1] > 0:
+                self.rect.bottom = collide.top
+                self.colliding['down'] = True
         if True in [self.colliding[x] for x in ['left', 'right']]:
             self.x = self.rect.x
         if True in [self.colliding[x] for x in ['up', 'down']]:
             self.y = self.rect.y
         self.calculate_velocity()
 
+    def sweep(self, is_solid, tile_size):
+        """Move by v one axis at a time through a tile grid, stopping at the first solid tile in the way"""
+        self.previous[0], self.previous[1] = self.x, self.y
+        for key in ['up', 'down', 'left', 'right']:
+            self.colliding[key] = False
+        self.contacts = []
+        if self.v[0]:
+            rows = range(math.floor(self.y / tile_size), math.ceil((self.y + self.h) / tile_size))
+            self.x, col, row = self.sweep_axis(self.x, self.w, self.v[0], rows,
+                                               lambda col, row: is_solid(row, col), tile_size)
+            if col is not None:
+                self.colliding['right' if self.v[0] > 0 else 'left'] = True
+                self.contacts.append(((-1 if self.v[0] > 0 else 1, 0), (row, col)))
+        if self.v[1]:
+            cols = range(math.floor(self.x / tile_size), math.ceil((self.x + self.w) / tile_size))
+            self.y, row, col = self.sweep_axis(self.y, self.h, self.v[1], cols, is_solid, tile_size)
+            if row is not None:
+                self.colliding['down' if self.v[1] > 0 else 'up'] = True
+                self.contacts.append(((0, -1 if self.v[1] > 0 else 1), (row, col)))
+        self.rect.x = int(self.x)
+        self.rect.y = int(self.y)
+        self.calculate_velocity()
+        return self.contacts
+
+    @staticmethod
+    def sweep_axis(start, size, delta, lanes, blocked, tile_size):
+        # only the cells the leading edge enters during this move are tested, nearest first
+        if delta > 0:
+            edge = start + size
+            cells = range(math.ceil(edge / tile_size), math.ceil((edge + delta) / tile_size))
+        else:
+            cells = range(math.floor(start / tile_size) - 1, math.floor((start + delta) / tile_size) - 1, -1)
+        for cell in cells:
+            for lane in lanes:
+                if blocked(cell, lane):
+                    return (cell*tile_size - size if delta > 0 else (cell + 1)*tile_size), cell, lane
+        return start + delta, None, None
+
     def check_collisions(self, objs):
         self.vert_collisions = []
         self.hori_collisions = []
@@ -80,18 +122,45 @@ class Physics2D:
         else:
             self.v[1] += 0.2*self.g
 
+    def clear_overlaps(self):
+        self.overlaps = []
+        self.submerged = False
+
+    def get_state(self):
+        return self.STATE.pack(self.x, self.y, self.v[0], self.v[1], self.previous[0], self.previous[1],
+                               *self.colliding.values(), self.submerged)
+
+    def set_state(self, data, offset=0):
+        values = Physics2D.STATE.unpack_from(data, offset)
+        self.x, self.y, self.v[0], self.v[1], self.previous[0], self.previous[1] = values[:6]
+        for key, value in zip(self.colliding, values[6:10]):
+            self.colliding[key] = value
+        self.submerged = values[10]
+        self.rect.x = int(self.x)
+        self.rect.y = int(self.y)
+        return offset + Physics2D.STATE.size
+
+    def on_overlap(self, other, first):
+        # called by EntityWorld for every entity or trigger overlapping this one
+        self.overlaps.append(other)
+        if other.obj_type == 2:  # underwater etc
+            self.submerged = True
+
 
 class Entity(Physics2D):
     animations = {}
+    variants = {}
 
     def __init__(self, x, y, w, h, animation_path):
         super().__init__(x, y, w, h)
         self.animate_index = None
         self.animate_list = None
         self.angle = 0  # degrees not radians
-        self.animation_type = animation_path.split('\\')[-1].replace('static/', '')[:-1]
+        self.animation_type = get_entity_type(animation_path)
         if self.animation_type not in Entity.animations.keys():
             Entity.animations[self.animation_type] = load_entity_animations(animation_path)[self.animation_type]
+            Entity.variants[self.animation_type] = load_transformed_variants(Entity.animations[self.animation_type],
+                                                                             [(False, False), (True, False)])
         self.animation = 'idle'
         self.flipped = False
         self.animation_timer = 0
@@ -102,146 +171,441 @@ class Entity(Physics2D):
     def set_pos(self, x, y):
         self.x = x
         self.y = y
+        self.previous = [x, y]
         self.rect.x = x
         self.rect.y = y
 
-    def draw(self, surface):
-        if self.flipped:
-            surface.blit(flip_image(Entity.animations[self.animation_type][self.animation][self.animation_index].copy()), (self.x, self.y))
-        else:
-            surface.blit(Entity.animations[self.animation_type][self.animation][self.animation_index].copy(), (self.x, self.y))
+    def get_draw_pos(self, alpha=1.0):
+        # blend between the last two simulation ticks when rendering between them
+        return (self.previous[0] + (self.x - self.previous[0]) * alpha,
+                self.previous[1] + (self.y - self.previous[1]) * alpha)
+
+    def get_frame(self, flip_x=None, flip_y=False, angle=None):
+        if flip_x is None:
+            flip_x = self.flipped
+        if angle is None:
+            angle = self.angle
+        variants = Entity.variants[self.animation_type]
+        key = (self.animation, flip_x, flip_y, angle)
+        if key not in variants:
+            # transforms not prepared at load time are built once on first use
+            flipped = (self.animation, flip_x, flip_y, 0)
+            if flipped not in variants:
+                variants[flipped] = [flip_image(frame, flip_x, flip_y)
+                                     for frame in Entity.animations[self.animation_type][self.animation]]
+            variants[key] = [pg.transform.rotate(frame, angle) for frame in variants[flipped]]
+        return variants[key][self.animation_index]
+
+    def draw(self, surface, alpha=1.0):
+        surface.blit(self.get_frame(), self.get_draw_pos(alpha))
 
     def draw_centre(self, surface):
-        if self.flipped:
-            surface.blit(
-                flip_image(Entity.animations[self.animation_type][self.animation][self.animation_index].copy()),
-                (self.x_middle - self.w//2, self.y_middle - self.h//2))
+        surface.blit(self.get_frame(), (self.x_middle - self.w//2, self.y_middle - self.h//2))
+
+
+class Trigger:
+    obj_type = 0  # non solid, like coins
+
+    def __init__(self, x, y, w, h, callback=None, once=False):
+        self.rect = pg.Rect(x, y, w, h)
+        self.callback = callback
+        self.once = once
+        self.alive = True
+
+    def on_overlap(self, other, first):
+        if first and self.alive:
+            if self.callback is not None:
+                self.callback(self, other)
+            if self.once:
+                self.alive = False
+
+
+class Pickup(Trigger):
+    def __init__(self, x, y, w, h, value=1, callback=None):
+        super().__init__(x, y, w, h, callback, once=True)
+        self.value = value
+
+
+class Volume(Trigger):
+    obj_type = 2  # underwater etc
+
+
+class EntityWorld:
+    """Uniform grid broad phase over moving entities and static triggers, dispatching overlaps to on_overlap"""
+
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.entities = []
+        self.triggers = []
+        self.trigger_cells = {}  # triggers do not move, so their cells are filled once
+        self.contacts = set()  # id pairs that overlapped on the last step
+
+    def cells(self, rect):
+        cs = self.cell_size
+        for cx in range(rect.left // cs, (rect.right - 1) // cs + 1):
+            for cy in range(rect.top // cs, (rect.bottom - 1) // cs + 1):
+                yield cx, cy
+
+    def add(self, obj):
+        if isinstance(obj, Trigger):
+            self.triggers.append(obj)
+            for cell in self.cells(obj.rect):
+                self.trigger_cells.setdefault(cell, []).append(obj)
+        else:
+            self.entities.append(obj)
+        return obj
+
+    def remove(self, obj):
+        if isinstance(obj, Trigger):
+            self.triggers.remove(obj)
+            for cell in self.cells(obj.rect):
+                self.trigger_cells[cell].remove(obj)
         else:
-            surface.blit(Entity.animations[self.animation_type][self.animation][self.animation_index].copy(),
-                         (self.x_middle - self.w//2, self.y_middle - self.h//2))
+            self.entities.remove(obj)
+
+    def query(self, rect):
+        found = []
+        for cell in self.cells(rect):
+            for trigger in self.trigger_cells.get(cell, ()):
+                if trigger.rect.colliderect(rect) and trigger not in found:
+                    found.append(trigger)
+        return found
+
+    def find_pairs(self):
+        grid = {}
+        seen = set()
+        pairs = []
+        for entity in self.entities:
+            for cell in self.cells(entity.rect):
+                bucket = grid.setdefault(cell, [])
+                # only objects sharing a cell are tested, each pair once
+                for other in bucket + self.trigger_cells.get(cell, []):
+                    key = (id(other), id(entity))
+                    if key not in seen:
+                        seen.add(key)
+                        if other.rect.colliderect(entity.rect):
+                            pairs.append((other, entity))
+                bucket.append(entity)
+        return pairs
+
+    def step(self):
+        for entity in self.entities:
+            entity.clear_overlaps()
+        contacts = set()
+        for a, b in self.find_pairs():
+            key = (id(a), id(b))
+            contacts.add(key)
+            first = key not in self.contacts
+            a.on_overlap(b, first)
+            b.on_overlap(a, first)
+        self.contacts = contacts
+        for trigger in [trigger for trigger in self.triggers if not trigger.alive]:
+            self.remove(trigger)
 
 
 class Map:
     def __init__(self, x_size, y_size, tile_size):
         self.tiles, self.tile_paths, self.tile_addons = load_tile_sequence('static/textures')
         self.tiles.extend(load_sprites('static/sprites'))
-        self.chunks = {}
+        self.textures = [self.tiles[0], self.tiles[1]]  # fill and top of streamed terrain
+        self.chunks = OrderedDict()  # streamed world chunks, least recently used first
+        self.chunk_futures = {}
+        self.chunk_executor = None
+        self.streamed_surfaces = {}
+        self.unbaked = set()
+        self.provisional = set()  # baked before the chunk above arrived, so their top row guessed air above
+        self.seed = 0
+        self.chunk_budget = 16*1024*1024  # bytes of streamed chunk data and baked surfaces kept around
+        self.stream_radius = (2, 1)
         self.x_size = x_size
         self.y_size = y_size
         self.tile_size = tile_size
         self.map = None
+        self.chunk_tiles = 16
+        self.chunk_surfaces = {}
+        self.dirty_chunks = set()
+        self.hidden_tiles = set()  # tiles drawn by something other than the map, e.g. water surfaces
+        self.solid_mask = None
+        self.mask_chunks = set()  # chunks already copied into solid_mask
+        self.tile_rects = {}
         self.load_map()
 
-    def load_map(self):
-        with open('static/levels/first.json', 'r') as f:
-            self.map = json.load(f)
+    def load_map(self, path='static/levels/first.json'):
+        if self.map is not None:
+            self.map.close()
+        self.map = load_level(path)
+        self.columns = self.map.width
+        self.chunk_surfaces = {}
+        self.dirty_chunks = set()
+        self.hidden_tiles = set()
+        self.solid_mask = None
+        self.mask_chunks = set()
+
+    def get_regions(self, tile):
+        return load_regions(self.map, tile)
+
+    def hide_tiles(self, tiles):
+        for row, col in tiles:
+            self.hidden_tiles.add((row, col))
+            self.dirty_chunks.add((col // self.chunk_tiles, row // self.chunk_tiles))
 
     def blit_map(self, surface, offset):
         x, y = surface.get_size()
-        for row_count, row in enumerate(self.map):
-            for tile_count, tile in enumerate(row):
-                x_pos = tile_count * self.tile_size - offset[0]
-                y_pos = row_count * self.tile_size - offset[1]
-                r = pg.Rect(x_pos, y_pos, self.tile_size, self.tile_size)
-                if 0 < r.x < x or x > r.x + r.w > 0:
-                    if tile != -1:
-                        surface.blit(self.tiles[tile].copy(), (x_pos, y_pos))
-                        if 0 <= tile <= len(self.tile_paths) - 1:
-                            if self.tile_paths[tile] in self.tile_addons.keys():
-                                addons = self.tile_addons[self.tile_paths[tile]]
-                                for t, xx, yy in zip([0, 1, 2, 3], [0, 1, -1, 0], [-1, 0, 0, 1]):
-                                    try:
-                                        if self.map[row_count + yy][tile_count + xx] != 1:
-                                            surface.blit(addons[t].copy(), (x_pos, y_pos))
-                                    except:
-                                        surface.blit(addons[t].copy(), (x_pos, y_pos))
-                    else:
-                        pass
-                else:
-                    pass
+        chunk_px = self.chunk_tiles * self.tile_size
+        rows = len(self.map)
+        cols = self.columns
+        first_cx = max(0, int(offset[0] // chunk_px))
+        first_cy = max(0, int(offset[1] // chunk_px))
+        last_cx = min((cols - 1) // self.chunk_tiles, int((offset[0] + x) // chunk_px))
+        last_cy = min((rows - 1) // self.chunk_tiles, int((offset[1] + y) // chunk_px))
+        draw_list = []
+        for cy in range(first_cy, last_cy + 1):
+            for cx in range(first_cx, last_cx + 1):
+                if (cx, cy) not in self.chunk_surfaces or (cx, cy) in self.dirty_chunks:
+                    self.bake_chunk(cx, cy)
+                draw_list.append((self.chunk_surfaces[(cx, cy)], (cx * chunk_px - offset[0], cy * chunk_px - offset[1])))
+        blit_list(surface, draw_list)
+
+    def bake_chunk(self, cx, cy):
+        chunk_px = self.chunk_tiles * self.tile_size
+        chunk = self.chunk_surfaces.get((cx, cy))
+        if chunk is None:
+            chunk = pg.Surface((chunk_px, chunk_px), pg.SRCALPHA)
+            self.chunk_surfaces[(cx, cy)] = chunk
+        chunk.fill((0, 0, 0, 0))
+        blit_list(chunk, self.tile_draw_list(cy * self.chunk_tiles, (cy + 1) * self.chunk_tiles,
+                                             cx * self.chunk_tiles, (cx + 1) * self.chunk_tiles))
+        self.dirty_chunks.discard((cx, cy))
+
+    def tile_draw_list(self, first_row, end_row, first_col, end_col):
+        """(surface, position) pairs for the tiles and addons in a block of the map, relative to its corner"""
+        draw_list = []
+        for row_count in range(first_row, min(len(self.map), end_row)):
+            row = self.map[row_count]
+            y = (row_count - first_row) * self.tile_size
+            for tile_count in range(first_col, min(len(row), end_col)):
+                tile = row[tile_count]
+                if tile == -1 or (row_count, tile_count) in self.hidden_tiles:
+                    continue
+                pos = ((tile_count - first_col) * self.tile_size, y)
+                draw_list.append((self.tiles[tile], pos))
+                for addon in self.get_tile_addons(row_count, tile_count, tile):
+                    draw_list.append((addon, pos))
+        return draw_list
+
+    def get_tile_addons(self, row_count, tile_count, tile):
+        addons = []
+        if 0 <= tile <= len(self.tile_paths) - 1:
+            if self.tile_paths[tile] in self.tile_addons.keys():
+                textures = self.tile_addons[self.tile_paths[tile]]
+                for t, xx, yy in zip([0, 1, 2, 3], [0, 1, -1, 0], [-1, 0, 0, 1]):
+                    try:
+                        if self.map[row_count + yy][tile_count + xx] != 1:
+                            addons.append(textures[t])
+                    except IndexError:
+                        addons.append(textures[t])
+        return addons
+
+    def set_tile(self, row, col, tile):
+        self.map[row][col] = tile
+        if self.solid_mask is not None:
+            # edited in place so holders of the mask see the change
+            self.solid_mask[row, col] = tile == 1
+        # addons of the four neighbours depend on this tile, so a tile on a chunk
+        # edge also dirties the chunk across that edge
+        for yy, xx in [(0, 0), (-1, 0), (1, 0), (0, -1), (0, 1)]:
+            if 0 <= row + yy and 0 <= col + xx:
+                self.dirty_chunks.add(((col + xx) // self.chunk_tiles, (row + yy) // self.chunk_tiles))
+
+    def get_solid_mask(self, area=None):
+        """Bool grid of solid tiles, filled in a chunk at a time for the (x, y, w, h) pixel area or all of the map"""
+        grid = self.map
+        size = grid.chunk_size
+        if self.solid_mask is None:
+            self.solid_mask = np.zeros((grid.height, grid.width), dtype=bool)
+            self.mask_chunks = set()
+        first_cx, first_cy = 0, 0
+        last_cx, last_cy = (grid.width - 1) // size, (grid.height - 1) // size
+        if area is not None:
+            span = size*self.tile_size
+            x, y, w, h = area
+            first_cx, first_cy = max(first_cx, int(x // span)), max(first_cy, int(y // span))
+            last_cx, last_cy = min(last_cx, int((x + w) // span)), min(last_cy, int((y + h) // span))
+        for cy in range(first_cy, last_cy + 1):
+            for cx in range(first_cx, last_cx + 1):
+                if (cx, cy) in self.mask_chunks:
+                    continue
+                self.mask_chunks.add((cx, cy))
+                block = self.solid_mask[cy*size:(cy + 1)*size, cx*size:(cx + 1)*size]
+                block[:] = (np.array(grid.get_chunk(cx, cy)) == 1)[:block.shape[0], :block.shape[1]]
+        return self.solid_mask
+
+    def is_solid(self, row, col):
+        return 0 <= row < len(self.map) and 0 <= col < self.columns and self.map.get(row, col) == 1
 
     def get_map_collisions(self, entity):
         collisions = []
-        e_x, e_y, e_w,e_h = entity
-        for row_index, row in enumerate(self.map):
-            y_size = row_index * self.tile_size
-            if e_y > y_size + self.tile_size:
-                continue
-            elif e_y+e_h < y_size:
-                break
-            for tile_index, tile in enumerate(row):
-                x_size = tile_index*self.tile_size
-                if tile == 1:
-                    if e_x > x_size + self.tile_size:
-                        continue
-                    elif e_x + e_w < x_size:
-                        break
-                    collisions.append(pg.Rect(x_size,
-                                              y_size,
-                                              self.tile_size, self.tile_size))
+        e_x, e_y, e_w, e_h = entity
+        first_row = max(0, math.ceil(e_y / self.tile_size) - 1)
+        last_row = min(len(self.map) - 1, math.floor((e_y + e_h) / self.tile_size))
+        first_col = max(0, math.ceil(e_x / self.tile_size) - 1)
+        last_col = math.floor((e_x + e_w) / self.tile_size)
+        for row_index in range(first_row, last_row + 1):
+            row = self.map[row_index]
+            for tile_index in range(first_col, min(len(row) - 1, last_col) + 1):
+                if row[tile_index] == 1:
+                    collisions.append(self.get_tile_rect(row_index, tile_index))
         return collisions
 
+    def get_tile_rect(self, row, col):
+        # rects are pooled per grid cell; callers must treat them as read only
+        rect = self.tile_rects.get((row, col))
+        if rect is None:
+            rect = pg.Rect(col * self.tile_size, row * self.tile_size, self.tile_size, self.tile_size)
+            self.tile_rects[(row, col)] = rect
+        return rect
+
     def initial_chunk(self):
-        self.chunks["0:0"] = [
-            [0 if line < 0.7*self.y_size//self.tile_size else 1]*int(self.x_size//self.tile_size) for line in
-            range(self.y_size//self.tile_size)]
+        self.get_chunk(0, 0)
+
+    def noise_function(self, column):
+        rows = self.y_size//self.tile_size
+        return int(rows*(0.4 + 0.4*fractal_noise(column/24, self.seed)))
 
     def generate_chunk(self, x, y, noise_function=None):
-        self.chunks[f"{x}:{y}"] = [
-            [0 if line < 0.6*self.y_size//self.tile_size else 1]*int(self.x_size//self.tile_size)
-            for line in range(self.y_size//self.tile_size)]
+        # runs on the stream workers, so it only reads from self
+        if noise_function is None:
+            noise_function = self.noise_function
+        columns = self.x_size//self.tile_size
+        rows = self.y_size//self.tile_size
+        ground = [noise_function(x*columns + column) for column in range(columns)]
+        return [[1 if y*rows + row >= height else -1 for height in ground] for row in range(rows)]
+
+    def get_chunk(self, x, y):
+        key = (int(x), int(y))
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+        future = self.chunk_futures.pop(key, None)
+        # only blocks when the simulation needs a chunk before the streamer has it
+        self.add_chunk(key, future.result() if future is not None else self.generate_chunk(*key))
+        self.evict_chunks(key)
+        return self.chunks[key]
+
+    def add_chunk(self, key, chunk):
+        self.chunks[key] = chunk
+        self.unbaked.add(key)
+        below = (key[0], key[1] + 1)
+        if below in self.provisional:
+            self.provisional.discard(below)
+            self.unbaked.add(below)
+
+    def is_streamed_solid(self, row, col):
+        cx, col = divmod(col, self.x_size//self.tile_size)
+        cy, row = divmod(row, self.y_size//self.tile_size)
+        chunk = self.chunks.get((cx, cy))
+        if chunk is None:
+            # never wait on a worker inside a tick, a body stops at a chunk that has not arrived yet
+            self.request_chunk((cx, cy))
+            return True
+        return chunk[row][col] == 1
+
+    def request_chunk(self, key):
+        if key in self.chunks or key in self.chunk_futures:
+            return
+        if self.chunk_executor is None:
+            self.chunk_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='chunks')
+        self.chunk_futures[key] = self.chunk_executor.submit(self.generate_chunk, *key)
+
+    def stream_chunks(self, centre):
+        x, y = int(centre[0]//self.x_size), int(centre[1]//self.y_size)
+        wanted = [(x + xx, y + yy) for xx in range(-self.stream_radius[0], self.stream_radius[0] + 1)
+                  for yy in range(-self.stream_radius[1], self.stream_radius[1] + 1)]
+        wanted.sort(key=lambda key: abs(key[0] - x) + abs(key[1] - y))
+        for key in wanted:
+            self.request_chunk(key)
+        for key, future in list(self.chunk_futures.items()):
+            if future.done():
+                del self.chunk_futures[key]
+                self.add_chunk(key, future.result())
+        if self.unbaked:
+            # bake at most one chunk per call to spread the work over frames
+            key = min(self.unbaked, key=lambda key: abs(key[0] - x) + abs(key[1] - y))
+            self.unbaked.discard(key)
+            self.bake_streamed_chunk(key)
+        self.evict_chunks((x, y))
+
+    def evict_chunks(self, centre):
+        columns = self.x_size//self.tile_size
+        rows = self.y_size//self.tile_size
+        chunk_bytes = rows*(56 + 8*columns)
+        surface_bytes = self.x_size*self.y_size*4  # a baked surface dwarfs the tile lists
+        for key in list(self.chunks):
+            if len(self.chunks)*chunk_bytes + len(self.streamed_surfaces)*surface_bytes <= self.chunk_budget:
+                break
+            if abs(key[0] - centre[0]) > self.stream_radius[0] or abs(key[1] - centre[1]) > self.stream_radius[1]:
+                del self.chunks[key]
+                self.streamed_surfaces.pop(key, None)
+                self.unbaked.discard(key)
+                self.provisional.discard(key)
 
     def get_chunk_collisions(self, x, y, entity):
         collisions = []
-        if f"{int(x)}:{int(y)}" not in self.chunks.keys():
-            self.generate_chunk(x, int(y))
+        x, y = int(x), int(y)
+        chunk = self.get_chunk(x, y)
         if entity is not None:
-            e_x, e_y, e_w,e_h = entity
-            for row_index, row in enumerate(self.chunks[f"{int(x)}:{int(y)}"]):
-                y_size = y * self.y_size + row_index * self.tile_size
-                if e_y > y_size + self.tile_size:
-                    continue
-                elif e_y+e_h < y_size:
-                    break
-                for tile_index, tile in enumerate(row):
-                    x_size = x*self.x_size + tile_index*self.tile_size
-                    if tile == 1:
-                        if e_x > x_size + self.tile_size:
-                            continue
-                        elif e_x + e_w < x_size:
-                            break
-                        collisions.append(pg.Rect(x_size,
-                                                  y_size,
-                                                  self.tile_size, self.tile_size))
+            e_x, e_y, e_w, e_h = entity
+            e_x -= x*self.x_size
+            e_y -= y*self.y_size
+            first_row = max(0, math.ceil(e_y / self.tile_size) - 1)
+            last_row = min(len(chunk) - 1, math.floor((e_y + e_h) / self.tile_size))
+            first_col = max(0, math.ceil(e_x / self.tile_size) - 1)
+            last_col = min(len(chunk[0]) - 1, math.floor((e_x + e_w) / self.tile_size))
         else:
-            for row_index, row in enumerate(self.chunks[f"{int(x)}:{int(y)}"]):
-                y_size = y * self.y_size + row_index * self.tile_size
-                for tile_index, tile in enumerate(row):
-                    x_size = x*self.x_size + tile_index*self.tile_size
-                    if tile == 1:
-                        collisions.append(pg.Rect(x_size,
-                                                  y_size,
-                                                  self.tile_size, self.tile_size))
+            first_row, last_row, first_col, last_col = 0, len(chunk) - 1, 0, len(chunk[0]) - 1
+        for row_index in range(first_row, last_row + 1):
+            y_size = y*self.y_size + row_index*self.tile_size
+            for tile_index in range(first_col, last_col + 1):
+                if chunk[row_index][tile_index] == 1:
+                    collisions.append(pg.Rect(x*self.x_size + tile_index*self.tile_size, y_size,
+                                              self.tile_size, self.tile_size))
         return collisions
 
+    def bake_streamed_chunk(self, key):
+        chunk = self.chunks[key]
+        above = self.chunks.get((key[0], key[1] - 1))
+        if above is None:
+            self.provisional.add(key)
+        else:
+            self.provisional.discard(key)
+        surface = self.streamed_surfaces.get(key)
+        if surface is None:
+            surface = pg.Surface((self.x_size, self.y_size))
+            self.streamed_surfaces[key] = surface
+        surface.fill((204, 255, 255))
+        draw_list = []
+        for row_index, row in enumerate(chunk):
+            for tile_index, tile in enumerate(row):
+                if tile == 1:
+                    top = chunk[row_index-1][tile_index] != 1 if row_index else \
+                        above is None or above[-1][tile_index] != 1
+                    draw_list.append((self.textures[1] if top else self.textures[0],
+                                      (tile_index*self.tile_size, row_index*self.tile_size)))
+        blit_list(surface, draw_list)
+        return surface
+
     def blit_chunk(self, surface, x_index, y_index, offset=(0, 0)):
         x, y = surface.get_size()
+        draw_list = []
         for xx in range(-1, 2):
-            if f"{int(x_index+xx)}:{int(y_index)}" not in self.chunks.keys():
-                self.generate_chunk(x_index+xx, int(y_index))
-            chunk = self.chunks[f"{int(x_index+xx)}:{int(y_index)}"]
-            for row_index, row in enumerate(chunk):
-                for tile_index, tile in enumerate(row):
-                    x_pos = (x_index+xx)*self.x_size + tile_index*self.tile_size + offset[0]
-                    y_pos = y_index*self.y_size + row_index*self.tile_size + offset[1]
-                    r = pg.Rect(x_pos, y_pos, self.tile_size, self.tile_size)
-                    if 0 < r.x < x or x > r.x + r.w > 0:
-                        if tile == 1:
-                            if chunk[row_index-1][tile_index] != 1:
-                                surface.blit(self.textures[1], (x_pos, y_pos))
-                            else:
-                                surface.blit(self.textures[0], (x_pos, y_pos))
-                        else:
-                            pg.draw.rect(surface, (204, 255, 255), r)
-                    elif r.x > x:
-                        break
+            key = (int(x_index + xx), int(y_index))
+            x_pos = key[0]*self.x_size + offset[0]
+            y_pos = key[1]*self.y_size + offset[1]
+            if x_pos + self.x_size <= 0 or x_pos >= x:
+                continue
+            chunk_surface = self.streamed_surfaces.get(key)
+            if chunk_surface is None:
+                # not baked yet, stream_chunks gets to it within a few frames
+                continue
+            draw_list.append((chunk_surface, (x_pos, y_pos)))
+        blit_list(surface, draw_list)
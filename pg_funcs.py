@@ -1,6 +1,8 @@
 import pygame as pg
 import os.path
 import glob
+import math
+from assets import load_image, load_image_variants, preload_assets, save_asset_cache
 
 
 def create_text_object(text, font, position: tuple, color, max_size=(0, 0), line_width=20):
@@ -42,6 +44,111 @@ def blit_text_object(surface, text_obj):
         surface.blit(text_obj[0], text_obj[1])
 
 
+def blit_list(surface, draw_list):
+    # one call for a whole list of (surface, position) pairs instead of a python level blit each
+    if hasattr(surface, 'fblits'):
+        surface.fblits(draw_list)
+    else:
+        surface.blits(draw_list, doreturn=False)
+
+
+class PresentLayer:
+    def __init__(self, source, rect, buffer):
+        self.source = source
+        self.rect = rect
+        self.buffer = buffer
+        self.direct = buffer is None
+        sw, sh = source.get_size()
+        # whole multiples let dirty parts be scaled on their own without seams
+        factor = rect.w // sw
+        self.factor = factor if factor and rect.w == sw*factor and rect.h == sh*factor else None
+        self.dirty = [source.get_rect()]
+
+    def mark(self, rect=None):
+        if rect is None or self.factor is None:
+            self.dirty = [self.source.get_rect()]
+        else:
+            self.dirty.append(pg.Rect(rect).clip(self.source.get_rect()))
+
+    def scale(self, display):
+        """Scale the dirty parts of the source into the buffer, returning the display rects that changed"""
+        if not self.dirty:
+            return []
+        target = display if self.direct else self.buffer
+        changed = []
+        whole = self.source.get_rect()
+        if self.factor is None or whole in self.dirty:
+            pg.transform.scale(self.source, self.rect.size, target.subsurface(self.rect) if self.direct and
+                               self.rect != display.get_rect() else target)
+            changed.append(self.rect)
+        else:
+            f = self.factor
+            for rect in self.dirty:
+                if rect.w and rect.h:
+                    scaled = pg.Rect(rect.x*f, rect.y*f, rect.w*f, rect.h*f)
+                    if self.direct:
+                        scaled.move_ip(self.rect.topleft)
+                    pg.transform.scale(self.source.subsurface(rect), scaled.size, target.subsurface(scaled))
+                    changed.append(scaled if self.direct else scaled.move(self.rect.topleft))
+        self.dirty = []
+        return changed
+
+
+class Presenter:
+    """Upscales low resolution layers into the display through preallocated surfaces, updating only what changed"""
+
+    def __init__(self, display=None):
+        self.display = display if display is not None else pg.display.get_surface()
+        self.layers = []
+        self.rects = []  # display rects waiting for the next update
+
+    def add_layer(self, source, size, pos=(0, 0)):
+        rect = pg.Rect(pos, (int(size[0]), int(size[1])))
+        # the bottom layer is scaled straight into the display when the formats match, the rest keep a buffer
+        if not self.layers and source.get_bitsize() == self.display.get_bitsize():
+            buffer = None
+        else:
+            buffer = pg.Surface(rect.size, 0, source)
+        self.layers.append(PresentLayer(source, rect, buffer))
+        return self.layers[-1]
+
+    def mark(self, layer=0, rect=None):
+        self.layers[layer].mark(rect)
+
+    def mark_all(self):
+        for layer in self.layers:
+            layer.mark()
+
+    def mark_display(self, rect):
+        """Rescale whatever lies under a display rect, e.g. after drawing an overlay on top of the output"""
+        for layer in self.layers:
+            if layer.rect.colliderect(rect):
+                area = pg.Rect(rect).clip(layer.rect).move(-layer.rect.x, -layer.rect.y)
+                sw, sh = layer.source.get_size()
+                x1, y1 = area.left*sw // layer.rect.w, area.top*sh // layer.rect.h
+                x2, y2 = -(-area.right*sw // layer.rect.w), -(-area.bottom*sh // layer.rect.h)
+                layer.mark(pg.Rect(x1, y1, x2 - x1, y2 - y1))
+
+    def add_rect(self, rect):
+        self.rects.append(pg.Rect(rect))
+
+    def present(self):
+        covered = []
+        for layer in self.layers:
+            changed = layer.scale(self.display)
+            if not layer.direct:
+                # buffered layers are blitted again wherever a layer below them was redrawn
+                for rect in changed + [rect.clip(layer.rect) for rect in covered if rect.colliderect(layer.rect)]:
+                    self.display.blit(layer.buffer, rect.topleft, rect.move(-layer.rect.x, -layer.rect.y))
+            covered.extend(changed)
+        self.rects.extend(covered)
+
+    def update(self):
+        if self.rects:
+            pg.display.update(self.rects)
+            self.rects = []
+
+
 def create_button(pos, size, color=pg.color.Color('white'),
                   text_color=pg.color.Color('black'), text=None, font=None):
     _rect = (pg.rect.Rect(pos[0], pos[1], size[0], size[1]), color)
@@ -69,10 +176,8 @@ def flip_image(img, x_boolean=True, y_boolean=False):
 
 def load_animation_sequence(descriptor, color_key=None):
     animations = []
-    for path in glob.glob(descriptor.replace('\\', '/') + '/*'):
-        animations.append(pg.image.load(path).convert())
-        if color_key:
-            animations[-1].set_colorkey(color_key)
+    for path in sorted(glob.glob(descriptor.replace('\\', '/') + '/*')):
+        animations.append(load_image(path, False, color_key))
     return animations
 
 
@@ -80,73 +185,103 @@ def load_tile_sequence(descriptor, color_key=None):
     animations = []
     animation_paths = []
     addons = {}
-    for path in glob.glob(descriptor.replace('\\', '/') + '/*'):
-        animations.append(pg.image.load(path).convert_alpha())
+    for path in sorted(glob.glob(descriptor.replace('\\', '/') + '/*')):
+        animations.append(load_image(path, color_key=color_key))
         path = path.replace('textures', 'texture_addons')
         animation_paths.append(path)
         if os.path.isfile(path):
             addons[path] = load_texture_addons(path)
-        if color_key:
-            animations[-1].set_colorkey(color_key)
     return animations, animation_paths, addons
 
 
+def build_texture_addons(image):
+    return [image.copy(),
+            flip_image(pg.transform.rotate(image.copy(), 90)).convert_alpha(),
+            pg.transform.rotate(image.copy(), 90).convert_alpha(),
+            flip_image(image.copy(), False, True).convert_alpha()]
+
+
 def load_texture_addons(path, color_key=None):
-    animations = []
-    image = pg.image.load(path).convert_alpha()
-    animations.append(image.copy())
-    animations.append(flip_image(pg.transform.rotate(image.copy(), 90)).convert_alpha())
-    animations.append(pg.transform.rotate(image.copy(), 90).convert_alpha())
-    animations.append(flip_image(image.copy(), False, True).convert_alpha())
+    animations = list(load_image_variants(path, 'addons', build_texture_addons))
     if color_key:
-        animations[-2].set_colorkey(color_key)
-        animations[-1].set_colorkey(color_key)
+        # keyed copies of the last two surfaces
+        animations[2:] = load_image_variants(path, 'addons', build_texture_addons, color_key)[2:]
     return animations
 
 
+SPRITE_VARIANTS = {
+    'horizontal': lambda image: [image.copy(), flip_image(image.copy())],
+    'vertical': lambda image: [image.copy(), flip_image(image.copy(), False, True)],
+    'all': lambda image: [image.copy(), flip_image(pg.transform.rotate(image.copy(), 90)),
+                          pg.transform.rotate(image.copy(), 90), flip_image(image.copy(), False, True)],
+}
+
+
 def load_sprites(descriptor, color_key=None):
     animations = []
-    for path in glob.glob(descriptor.replace('\\', '/') + '/*'):
+    for path in sorted(glob.glob(descriptor.replace('\\', '/') + '/*')):
         if '.png' in path:
-            animations.append(pg.image.load(path).convert_alpha())
-            if color_key:
-                animations[-1].set_colorkey(color_key)
+            animations.append(load_image(path, color_key=color_key))
         else:
             pass
-    for path in glob.glob(descriptor.replace('\\', '/') + '/**/*', recursive=True):
-        if '.png' in path and 'horizontal\\' in path:
-            image = pg.image.load(path).convert_alpha()
-            animations.append(image.copy())
-            animations.append(flip_image(image.copy()))
-            if color_key:
-                animations[-2].set_colorkey(color_key)
-                animations[-1].set_colorkey(color_key)
-        elif '.png' in path and 'vertical\\' in path:
-            image = pg.image.load(path).convert_alpha()
-            animations.append(image.copy())
-            animations.append(flip_image(image.copy(), False, True))
+    for path in sorted(glob.glob(descriptor.replace('\\', '/') + '/**/*', recursive=True)):
+        folder = os.path.basename(os.path.dirname(path))
+        if '.png' in path and folder in SPRITE_VARIANTS:
+            variants = list(load_image_variants(path, folder, SPRITE_VARIANTS[folder]))
             if color_key:
-                animations[-2].set_colorkey(color_key)
-                animations[-1].set_colorkey(color_key)
-        elif '.png' in path and 'all\\' in path:
-            image = pg.image.load(path).convert_alpha()
-            animations.append(image.copy())
-            animations.append(flip_image(pg.transform.rotate(image.copy(), 90)))
-            animations.append(pg.transform.rotate(image.copy(), 90))
-            animations.append(flip_image(image.copy(), False, True))
-            if color_key:
-                animations[-2].set_colorkey(color_key)
-                animations[-1].set_colorkey(color_key)
+                # keyed copies of the last two surfaces
+                variants[-2:] = load_image_variants(path, folder, SPRITE_VARIANTS[folder], color_key)[-2:]
+            animations.extend(variants)
         else:
             pass
 
     return animations
 
 
+def get_entity_type(descriptor):
+    return os.path.basename(os.path.normpath(descriptor.replace('\\', '/')))
+
+
 def load_entity_animations(descriptor):
-    d = descriptor.split('\\')[-1].replace('static/', '')[:-1]
+    d = get_entity_type(descriptor)
     animations = {d: {}}
-    for animation_path in glob.glob(descriptor+'*'):
-        a = animation_path.split('\\')[-1]
+    for animation_path in sorted(glob.glob(descriptor+'*')):
+        a = os.path.basename(animation_path)
         animations[d][a] = load_animation_sequence(animation_path, (0,0,0))
     return animations
+
+
+def load_transformed_variants(animations, flips):
+    variants = {}
+    for animation, frames in animations.items():
+        for flip_x, flip_y in flips:
+            if flip_x or flip_y:
+                variants[(animation, flip_x, flip_y, 0)] = [flip_image(frame, flip_x, flip_y) for frame in frames]
+            else:
+                variants[(animation, flip_x, flip_y, 0)] = frames
+    return variants
+
+
+def lattice_value(i, seed=0):
+    h = (i*374761393 + seed*668265263) & 0xffffffff
+    h = ((h ^ (h >> 13))*1274126177) & 0xffffffff
+    return (h ^ (h >> 16)) / 0x100000000
+
+
+def value_noise(x, seed=0):
+    i = math.floor(x)
+    t = x - i
+    t = t*t*(3 - 2*t)
+    a = lattice_value(i, seed)
+    return a + (lattice_value(i + 1, seed) - a)*t
+
+
+def fractal_noise(x, seed=0, octaves=3):
+    total = 0
+    amplitude = 1
+    norm = 0
+    for octave in range(octaves):
+        total += value_noise(x*2**octave, seed + octave)*amplitude
+        norm += amplitude
+        amplitude /= 2
+    return total / norm
@@ -1,6 +1,10 @@
 import math
 import random
+import struct
+from itertools import islice
+import numpy as np
 import pygame as pg
+from pg_funcs import blit_list
 
 
 class Water:
@@ -12,12 +16,12 @@ class Water:
         self.divider_amount = 2
         self.length = (self.p2-self.p1)//self.divider_amount + 1
         self.points = [(self.divider_amount*x, self.target_height) for x in range(self.length+1)]
-        self.springs = [self.target_height for _ in range(self.length)]
-        self.distances = [0]*len(self.springs)
-        self.speeds = [0]*len(self.springs)
-        self.heights = [self.target_height]*len(self.springs)
-        self.lDeltas = [0]*len(self.springs)
-        self.rDeltas = [0]*len(self.springs)
+        self.springs = np.full(self.length, self.target_height, dtype=float)
+        self.distances = np.zeros(self.length)
+        self.speeds = np.zeros(self.length)
+        self.heights = np.full(self.length, self.target_height, dtype=float)
+        self.lDeltas = np.zeros(self.length)
+        self.rDeltas = np.zeros(self.length)
 
         self.number_of_loops = 1
         self.tension = 0.035
@@ -29,28 +33,23 @@ class Water:
         self.started = False
 
     def spring_set(self):
-        for i in range(self.length):
-            self.distances[i] = self.target_height - self.heights[i]
-            self.speeds[i] += self.tension*self.distances[i] - self.speeds[i]*self.dampening
-            self.heights[i] += self.speeds[i]
+        np.subtract(self.target_height, self.heights, out=self.distances)
+        self.speeds += self.tension*self.distances - self.speeds*self.dampening
+        self.heights += self.speeds
 
     def delta_calculation(self):
         for j in range(self.number_of_loops):
-            for i in range(self.length):
-                if i > 0:
-                    self.lDeltas[i] = self.spread*(self.heights[i] - self.heights[i-1])
-                    self.springs[i-1] += self.lDeltas[i]
-                if i < self.length - 1:
-                    self.rDeltas[i] = self.spread * (self.heights[i] - self.heights[i + 1])
-                    self.springs[i + 1] += self.rDeltas[i]
+            np.subtract(self.heights[1:], self.heights[:-1], out=self.lDeltas[1:])
+            self.lDeltas[1:] *= self.spread
+            np.subtract(self.heights[:-1], self.heights[1:], out=self.rDeltas[:-1])
+            self.rDeltas[:-1] *= self.spread
+            self.springs[:-1] += self.lDeltas[1:]
+            self.springs[1:] += self.rDeltas[:-1]
             self.terminate_delta()
 
     def terminate_delta(self):
-        for i in range(self.length):
-            if i > 0:
-                self.heights[i - 1] += self.lDeltas[i]
-            if i < self.length - 1:
-                self.heights[i + 1] += self.rDeltas[i]
+        self.heights[:-1] += self.lDeltas[1:]
+        self.heights[1:] += self.rDeltas[:-1]
 
     def run(self, entity, vh, vx):
         ex, ey, ew, eh = entity
@@ -79,26 +78,19 @@ class Water:
     def test_end_water_waves(self):
         """Check if the waves are still alive"""
 
-        count = 0
-
-        for i in range(self.length):
-            if not int(self.speeds[i]) and not int(self.distances[i]):
-                count += 1
-
-        if count == self.length:
+        if np.all((np.abs(self.speeds) < 1) & (np.abs(self.distances) < 1)):
             self.stop_water_motion()
 
     def stop_water_motion(self):
         """Stop the motion of the water"""
 
-        for i in range(self.length):
-            self.speeds[i] = 0
-            self.heights[i] = self.target_height
-            self.distances[i] = 0
+        self.speeds[:] = 0
+        self.heights[:] = self.target_height
+        self.distances[:] = 0
 
     def draw(self, surface, offset):
         s = pg.Surface((self.p2-self.p1, 16))
-        points = [(self.points[x][0], self.heights[x]) for x in range(self.length)]
+        points = [(self.points[x][0], h) for x, h in enumerate(self.heights.tolist())]
         points.append((self.length*self.divider_amount, 16))
         points.insert(0, (0, 16))
         pg.draw.polygon(s, (35, 150, 230), points)
@@ -108,95 +100,667 @@ class Water:
         surface.blit(s, (self.p1-offset[0], self.surface_height - offset[1]))
 
 
+class WaterSystem:
+    def __init__(self, bodies):
+        self.bodies = bodies
+        self.lengths = np.array([body.length for body in bodies], dtype=int)
+        self.starts = np.zeros(len(bodies), dtype=int)
+        if len(bodies):
+            self.starts[1:] = np.cumsum(self.lengths)[:-1]
+        total = int(self.lengths.sum())
+        self.heights = np.zeros(total)
+        self.speeds = np.zeros(total)
+        self.distances = np.zeros(total)
+        self.springs = np.zeros(total)
+        self.lDeltas = np.zeros(total)
+        self.rDeltas = np.zeros(total)
+        self.target = np.zeros(total)
+        self.tension = np.zeros(total)
+        self.dampening = np.zeros(total)
+        self.loop_spreads = []
+        spread = np.zeros(total)
+        loops = np.zeros(total, dtype=int)
+        for body, start, length in zip(bodies, self.starts, self.lengths):
+            segment = slice(start, start + length)
+            for name in ['heights', 'speeds', 'distances', 'springs', 'lDeltas', 'rDeltas']:
+                buffer = getattr(self, name)
+                buffer[segment] = getattr(body, name)
+                setattr(body, name, buffer[segment])
+            self.target[segment] = body.target_height
+            self.tension[segment] = body.tension
+            self.dampening[segment] = body.dampening
+            spread[segment] = body.spread
+            loops[segment] = body.number_of_loops
+        # springs only exchange height with neighbours of the same body
+        spread[self.starts] = 0
+        for j in range(int(loops.max()) if total else 0):
+            self.loop_spreads.append(spread * (loops > j))
+
+        self.x1 = np.array([body.p1 for body in bodies], dtype=float)
+        self.x2 = np.array([body.p1 + body.points[-1][0] for body in bodies], dtype=float)
+        self.x_end = np.array([body.p2 for body in bodies], dtype=float)
+        self.surface = np.array([body.surface_height + body.target_height for body in bodies], dtype=float)
+        self.divider = np.array([body.divider_amount for body in bodies], dtype=int)
+        self.timers = np.zeros(len(bodies), dtype=int)
+        self.trackers = {}
+        self.near = np.ones(len(bodies), dtype=bool)
+        self.resting = np.zeros(len(bodies), dtype=bool)
+        self.awake = None
+        self.active = None
+        self.active_spreads = []
+
+    def __len__(self):
+        return len(self.bodies)
+
+    def query(self, entity):
+        ex, ey, ew, eh = entity
+        return np.flatnonzero((self.x1 < ex) & (self.x2 > ex + ew) & (ey < self.surface) & (self.surface < ey + eh))
+
+    def splash(self, entity, vh, vx, key=0):
+        if key not in self.trackers:
+            self.trackers[key] = [0, np.zeros(len(self.bodies), dtype=bool)]
+        tracker = self.trackers[key]
+        last_vh, started = tracker
+        if 0 < vh < last_vh:
+            started[:] = False
+        elif 0 > last_vh and vh >= 0:
+            started[:] = False
+        ex, ey, ew, eh = entity
+        i = int(ex + (ew/2))
+        hits = []
+        for k in self.query(entity):
+            start, p1, divider = self.starts[k], int(self.x1[k]), self.divider[k]
+            if vh not in [0, 0.2] and not started[k]:
+                self.speeds[start + (i-p1)//divider] = 5 *(vh/abs(vh))
+                started[k] = True
+                self.wake(k)
+                hits.append(k)
+            elif vx != 0:
+                if -2 < self.speeds[start + (i + 6 - p1) // divider] < 2:
+                    self.speeds[start + (i + 6*int((vx / abs(vx))) - p1) // divider] = -0.4
+                    self.wake(k)
+        tracker[0] = vh
+        return hits
+
+    def snapshot(self):
+        # distances and deltas are recomputed at the start of every step, so only heights and speeds are kept
+        parts = [self.heights.tobytes(), self.speeds.tobytes(), self.timers.tobytes(), self.resting.tobytes(),
+                 struct.pack('<H', len(self.trackers))]
+        for key, (last_vh, started) in self.trackers.items():
+            parts.append(struct.pack('<id', key, last_vh))
+            parts.append(started.tobytes())
+        return b''.join(parts)
+
+    def restore(self, data, offset=0):
+        springs, bodies = len(self.heights), len(self.bodies)
+        for buffer, count in [(self.heights, springs), (self.speeds, springs), (self.timers, bodies),
+                              (self.resting, bodies)]:
+            buffer[:] = np.frombuffer(data, buffer.dtype, count, offset)
+            offset += buffer.nbytes
+        count, = struct.unpack_from('<H', data, offset)
+        offset += 2
+        self.trackers = {}
+        for _ in range(count):
+            key, last_vh = struct.unpack_from('<id', data, offset)
+            offset += 12
+            self.trackers[key] = [last_vh, np.frombuffer(data, bool, bodies, offset).copy()]
+            offset += bodies
+        return offset
+
+    def set_view(self, view, margin=64):
+        """Bodies further than margin from the camera rect stop simulating until it comes back near them"""
+        left, top, w, h = view
+        self.near = ((self.x_end > left - margin) & (self.x1 < left + w + margin) &
+                     (self.surface > top - margin) & (self.surface < top + h + margin))
+
+    def wake(self, k):
+        self.resting[k] = False
+        self.timers[k] = 0
+
+    def step(self):
+        awake = self.near & ~self.resting
+        if not awake.any():
+            return
+        if awake.all():
+            self.integrate(self.heights, self.speeds, self.distances, self.springs, self.lDeltas, self.rDeltas,
+                           self.target, self.tension, self.dampening, self.loop_spreads)
+        else:
+            if self.awake is None or (awake != self.awake).any():
+                # springs of the awake bodies, packed; body starts keep a zero spread so bodies stay apart
+                self.awake = awake
+                self.active = np.flatnonzero(np.repeat(awake, self.lengths))
+                self.active_spreads = [spread[self.active] for spread in self.loop_spreads]
+            a = self.active
+            arrays = [buffer[a] for buffer in [self.heights, self.speeds, self.distances, self.springs,
+                                               self.lDeltas, self.rDeltas]]
+            self.integrate(*arrays, self.target[a], self.tension[a], self.dampening[a], self.active_spreads)
+            for buffer, values in zip([self.heights, self.speeds, self.distances, self.springs,
+                                       self.lDeltas, self.rDeltas], arrays):
+                buffer[a] = values
+        self.timers[awake] += 1
+        waiting = awake & (self.timers > 180)
+        if waiting.any():
+            moving = (np.abs(self.speeds) >= 1) | (np.abs(self.distances) >= 1)
+            stopped = waiting & ~np.logical_or.reduceat(moving, self.starts)
+            if stopped.any():
+                springs = np.repeat(stopped, self.lengths)
+                self.speeds[springs] = 0
+                self.heights[springs] = self.target[springs]
+                self.distances[springs] = 0
+                # flat water stays flat until something splashes into it
+                self.resting |= stopped
+
+    @staticmethod
+    def integrate(heights, speeds, distances, springs, lDeltas, rDeltas, target, tension, dampening, loop_spreads):
+        np.subtract(target, heights, out=distances)
+        speeds += tension*distances - speeds*dampening
+        heights += speeds
+        for spread in loop_spreads:
+            np.subtract(heights[1:], heights[:-1], out=lDeltas[1:])
+            lDeltas[1:] *= spread[1:]
+            np.subtract(heights[:-1], heights[1:], out=rDeltas[:-1])
+            rDeltas[:-1] *= spread[1:]
+            springs[:-1] += lDeltas[1:]
+            springs[1:] += rDeltas[:-1]
+            heights[:-1] += lDeltas[1:]
+            heights[1:] += rDeltas[:-1]
+
+    def run(self, entity, vh, vx):
+        hits = self.splash(entity, vh, vx)
+        self.step()
+        return hits
+
+    def draw(self, surface, offset):
+        width = surface.get_width()
+        visible = (self.x_end - offset[0] > 0) & (self.x1 - offset[0] < width)
+        for k in np.flatnonzero(visible):
+            self.bodies[k].draw(surface, offset)
+
+
 class Cloth:
-    def __init__(self, x, y, w, h):
+    STATE = struct.Struct('<3i2?')  # wind timer, wind, rest ticks, asleep, near
+
+    def __init__(self, x, y, w, h, precision=5):
         self.x = x
         self.y = y
         self.w = w
         self.max_points = 10
         self.h = h
-        self.cloth = []
-        self.vel = []
-        self.resting_distance = [1,1]
+        self.cloth = None
+        self.previous_cloth = None
+        self.vel = None
+        self.anchor = None
+        self.resting_distance = np.ones(2)
         self.generate_cloth()
-        self.previous_cloth = self.cloth
         self.timer = 0
         self.max_timer = 360
         self.mag = 0
         self.dt = 0.2
-        self.acc = (0,2)
-        self.calculate_precision = 5
+        self.acc = np.array([0, 2])
+        self.calculate_precision = precision
+        self.near = True
+        self.asleep = False
+        self.rest_ticks = 0
+        self.sleep_energy = 0.01  # largest point movement per tick still counted as resting
+        self.sleep_after = 30
 
     def generate_cloth(self):
-        self.resting_distance = [1 if self.w < 11 else self.w/10, 1 if self.h < 11 else self.h/10]
-        self.cloth = [[[self.x+self.resting_distance[0]*x, self.y+self.resting_distance[1]*y] for x in range(
-            self.max_points if self.w > 10 else self.w)] for y in range(self.max_points if self.h > 10 else self.h)]
-        self.vel = [[[0,0]]*len(self.cloth[0])]*len(self.cloth)
+        self.resting_distance = np.array([1 if self.w < 11 else self.w/10, 1 if self.h < 11 else self.h/10])
+        columns = self.max_points if self.w > 10 else self.w
+        rows = self.max_points if self.h > 10 else self.h
+        grid_x, grid_y = np.meshgrid(np.arange(columns), np.arange(rows))
+        self.cloth = np.stack([self.x + self.resting_distance[0]*grid_x,
+                               self.y + self.resting_distance[1]*grid_y], axis=-1).astype(float)
+        self.anchor = self.cloth[0].copy()
+        self.previous_cloth = self.cloth.copy()
+        self.vel = np.zeros_like(self.cloth)
 
     def update(self):
-        temp_cloth = self.cloth
+        if self.timer == self.max_timer:
+            # a new gust is about to start
+            self.wake()
+        if self.asleep or not self.near:
+            # the wind keeps changing while nobody watches, so the random stream does not depend on the camera
+            self.change_wind()
+            return
         self.wind_blow()
         self.verlet_integration()
         for _ in range(self.calculate_precision):
             self.linked_calculation()
-        self.cloth[0] = [[self.x+self.resting_distance[0]*x, self.y] for x in range(
-            self.max_points if self.w > 10 else self.w)]
-        self.previous_cloth = temp_cloth
+        self.cloth[0] = self.anchor
+        if np.abs(self.vel).max() < self.sleep_energy:
+            self.rest_ticks += 1
+            if self.rest_ticks >= self.sleep_after:
+                self.asleep = True
+                self.previous_cloth[:] = self.cloth
+        else:
+            self.rest_ticks = 0
 
-    def wind_blow(self):
+    def snapshot(self):
+        return b''.join([self.cloth.tobytes(), self.previous_cloth.tobytes(),
+                         self.STATE.pack(self.timer, self.mag, self.rest_ticks, self.asleep, self.near)])
+
+    def restore(self, data, offset=0):
+        for buffer in [self.cloth, self.previous_cloth]:
+            buffer[:] = np.frombuffer(data, buffer.dtype, buffer.size, offset).reshape(buffer.shape)
+            offset += buffer.nbytes
+        self.timer, self.mag, self.rest_ticks, self.asleep, self.near = self.STATE.unpack_from(data, offset)
+        return offset + self.STATE.size
+
+    def get_rect(self):
+        left, top = self.cloth.min(axis=(0, 1)).tolist()
+        right, bottom = self.cloth.max(axis=(0, 1)).tolist()
+        return pg.Rect(int(left), int(top), int(right - left) + 1, int(bottom - top) + 1)
+
+    def set_view(self, view, margin=64):
+        self.near = self.get_rect().inflate(2*margin, 2*margin).colliderect(view)
+
+    def wake(self):
+        self.asleep = False
+        self.rest_ticks = 0
+
+    def change_wind(self):
         if self.timer == self.max_timer:
             self.mag = random.randint(-6,6)
             self.timer = 0
-        for row_count, row in enumerate(self.cloth):
-            for count, point in enumerate(row):
-                point[0] += row_count*row_count*self.mag/500
         self.timer += 1
 
+    def wind_blow(self):
+        self.change_wind()
+        rows = np.arange(len(self.cloth))
+        self.cloth[:, :, 0] += (rows*rows*self.mag/500)[:, None]
+
     def verlet_integration(self):
-        for row, vr, pr in zip(self.cloth[1:], self.vel[1:], self.previous_cloth[1:]):
-            for point, v, prev in zip(row, vr, pr):
-                for i in [0, 1]:
-                    v[i] = point[i] - prev[i]
-                    point[i] += v[i] + self.acc[i]*self.dt
+        np.subtract(self.cloth, self.previous_cloth, out=self.vel)
+        self.previous_cloth[:] = self.cloth
+        self.cloth[1:] += self.vel[1:] + self.acc*self.dt
 
     def linked_calculation(self):
-        self.cloth[0] = [[self.x+self.resting_distance[0]*x, self.y] for x in range(
-            self.max_points if self.w > 10 else self.w)]
-        for row_count, row in enumerate(self.cloth):
-            for count, point in enumerate(row):
-                if row_count != 0:
-                    point, self.cloth[row_count-1][count] = self.link_constraint(point, self.cloth[row_count-1][count])
-                if count != 0 and row_count != 0:
-                    point, row[count-1] = self.link_constraint(point, row[count-1])
+        self.cloth[0] = self.anchor
+        rows, columns = self.cloth.shape[:2]
+        # links are relaxed in two interleaved halves so no point is moved by two links at once
+        for first in [1, 2]:
+            self.link_constraint(self.cloth[first::2], self.cloth[first-1:rows-1:2])
+        for first in [1, 2]:
+            self.link_constraint(self.cloth[1:, first::2], self.cloth[1:, first-1:columns-1:2])
 
     def link_constraint(self, p1, p2):
-        d = [0, 0]
-        translate = [0, 0]
-        for i in [0, 1]:
-            d[i] = p1[i] - p2[i]
-        sd = math.sqrt(d[0]*d[0]+d[1]*d[1])
-        diff = []
-        for i in [0,1]:
-            diff.append((self.resting_distance[i]-sd)/sd)
-        for i in [0, 1]:
-            translate[i] = d[i]*0.5*diff[i]
-            p1[i] += translate[i]
-            p2[i] -= translate[i]
+        d = p1 - p2
+        sd = np.maximum(np.sqrt((d*d).sum(axis=-1, keepdims=True)), 1e-9)
+        translate = d*0.5*(self.resting_distance-sd)/sd
+        p1 += translate
+        p2 -= translate
         return p1, p2
 
-    def draw(self, surface):
-        points = []
-        ly = len(self.cloth)
-        lx = len(self.cloth[0])
-        for i in [lx-1, 0]:
-            points.append(self.cloth[0][i])
-        for i in range(1, ly):
-            points.append(self.cloth[i][0])
-        for i in range(1, lx-1):
-            points.append(self.cloth[ly-1][i])
-        x = []
-        for i in range(1, ly):
-            x.append(self.cloth[i][lx-1])
-        x.reverse()
-        points.extend(x)
+    def draw(self, surface, offset=(0, 0)):
+        cloth = (self.cloth - offset).tolist()
+        points = [cloth[0][-1], cloth[0][0]]
+        points.extend(row[0] for row in cloth[1:])
+        points.extend(cloth[-1][1:-1])
+        points.extend(row[-1] for row in reversed(cloth[1:]))
         pg.draw.polygon(surface, (125, 255, 125), points)
+
+
+class BatchContacts:
+    """Read only view of one body's contact row, used like the colliding dict of Physics2D"""
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    def __getitem__(self, direction):
+        return bool(self.batch.contacts[self.index, BodyBatch.columns[direction]])
+
+    def __iter__(self):
+        return iter(BodyBatch.directions)
+
+    def __len__(self):
+        return len(BodyBatch.directions)
+
+    def keys(self):
+        return BodyBatch.directions
+
+    def values(self):
+        return [self[direction] for direction in BodyBatch.directions]
+
+    def items(self):
+        return list(zip(BodyBatch.directions, self.values()))
+
+
+class BatchBody:
+    """Handle to one body of a BodyBatch with the attributes Physics2D and Entity code reads"""
+    obj_type = 1
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+        self.overlaps = []
+        self.submerged = False
+        self.colliding = BatchContacts(batch, index)
+        self.body_rect = pg.Rect(0, 0, 0, 0)
+
+    @property
+    def x(self):
+        return float(self.batch.pos[self.index, 0])
+
+    @x.setter
+    def x(self, value):
+        self.batch.pos[self.index, 0] = value
+
+    @property
+    def y(self):
+        return float(self.batch.pos[self.index, 1])
+
+    @y.setter
+    def y(self, value):
+        self.batch.pos[self.index, 1] = value
+
+    @property
+    def w(self):
+        return int(self.batch.size[self.index, 0])
+
+    @property
+    def h(self):
+        return int(self.batch.size[self.index, 1])
+
+    @property
+    def v(self):
+        # a view, so v[0] = ... writes through to the batch
+        return self.batch.vel[self.index]
+
+    @property
+    def previous(self):
+        return self.batch.previous[self.index]
+
+    @property
+    def g(self):
+        return float(self.batch.g[self.index])
+
+    @property
+    def rect(self):
+        # the same Rect every time, moved to where the body is now
+        x, y = self.batch.pos[self.index].tolist()
+        w, h = self.batch.size[self.index].tolist()
+        self.body_rect.update(int(x), int(y), w, h)
+        return self.body_rect
+
+    def set_pos(self, x, y):
+        self.batch.pos[self.index] = x, y
+        self.batch.previous[self.index] = x, y
+        self.batch.resting[self.index] = False
+
+    def clear_overlaps(self):
+        self.overlaps = []
+        self.submerged = False
+
+    def on_overlap(self, other, first):
+        self.overlaps.append(other)
+        if other.obj_type == 2:  # underwater etc
+            self.submerged = True
+
+
+class BodyBatch:
+    """Struct of arrays store for many simple bodies, integrated and collided with the tile grid in one pass"""
+    directions = ['up', 'down', 'left', 'right']
+    columns = {direction: column for column, direction in enumerate(directions)}
+    buffers = ['pos', 'previous', 'vel', 'size', 'g', 'life', 'contacts', 'alive', 'resting']
+
+    small_batch = 16  # up to this many moving bodies are swept one at a time, numpy's per call cost dominates below it
+
+    def __init__(self, capacity=256, max_fall=6, gravity=0.2, rest_speed=0.05):
+        self.max_fall = max_fall
+        self.gravity = gravity
+        self.rest_speed = rest_speed  # bodies on the ground slower than this stop being stepped
+        self.count = 0
+        self.pos = np.zeros((capacity, 2))
+        self.previous = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        self.size = np.zeros((capacity, 2), dtype=int)
+        self.g = np.zeros(capacity)
+        self.life = np.zeros(capacity, dtype=int)  # ticks left, 0 for bodies that stay until removed
+        self.contacts = np.zeros((capacity, 4), dtype=bool)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.resting = np.zeros(capacity, dtype=bool)
+        self.free = list(range(capacity - 1, -1, -1))
+        self.handles = [None]*capacity
+        self.solid = None
+        self.solid_source = None
+
+    def __len__(self):
+        return self.count
+
+    def grow(self):
+        capacity = len(self.alive)
+        for name in self.buffers:
+            old = getattr(self, name)
+            new = np.zeros((2*capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:capacity] = old
+            setattr(self, name, new)
+        self.free.extend(range(2*capacity - 1, capacity - 1, -1))
+        self.handles.extend([None]*capacity)
+
+    def add(self, x, y, w, h, g=1, v=(0, 0), life=0):
+        if not self.free:
+            self.grow()
+        index = self.free.pop()
+        self.pos[index] = self.previous[index] = x, y
+        self.vel[index] = v
+        self.size[index] = w, h
+        self.g[index] = g
+        self.life[index] = life
+        self.contacts[index] = False
+        self.alive[index] = True
+        self.resting[index] = False
+        self.handles[index] = BatchBody(self, index)
+        self.count += 1
+        return self.handles[index]
+
+    def remove(self, body):
+        self.alive[body.index] = False
+        self.handles[body.index] = None
+        self.free.append(body.index)
+        self.count -= 1
+
+    def wake(self, body):
+        self.resting[body.index] = False
+
+    def snapshot(self):
+        return b''.join([struct.pack('<I', len(self.alive))] + [getattr(self, name).tobytes() for name in self.buffers])
+
+    def restore(self, data, offset=0):
+        capacity, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        while len(self.alive) < capacity:
+            self.grow()
+        for name in self.buffers:
+            buffer = getattr(self, name)
+            shape = (capacity,) + buffer.shape[1:]
+            buffer[capacity:] = 0
+            buffer[:capacity] = np.frombuffer(data, buffer.dtype, math.prod(shape), offset).reshape(shape)
+            offset += buffer[:capacity].nbytes
+        # handles of bodies alive on both sides are kept, so references to them stay good
+        self.handles = [(handle or BatchBody(self, index)) if alive else None
+                        for index, (handle, alive) in enumerate(zip(self.handles, self.alive.tolist()))]
+        self.free = [index for index in range(len(self.alive) - 1, -1, -1) if not self.alive[index]]
+        self.count = len(self.alive) - len(self.free)
+        return offset
+
+    def bodies(self):
+        return [self.handles[index] for index in np.flatnonzero(self.alive)]
+
+    def step(self, solid=None, tile_size=16):
+        """One tick for every moving body: move by v against an optional 2D bool grid of solid tiles, then apply gravity"""
+        if not self.count:
+            return
+        timed = self.alive & (self.life > 0)
+        if timed.any():
+            self.life[timed] -= 1
+            for index in np.flatnonzero(timed & (self.life == 0)).tolist():
+                self.remove(self.handles[index])
+        index = np.flatnonzero(self.alive & ~self.resting)
+        if not len(index):
+            return
+        self.previous[index] = self.pos[index]
+        self.contacts[index] = False
+        if solid is None:
+            self.pos[index] += self.vel[index]
+        else:
+            if solid is not self.solid_source:
+                # the grid is converted once and reused until the caller hands over a new one
+                self.solid_source = solid
+                self.solid = np.asarray(solid, dtype=bool)
+            solid = self.solid
+            for axis in [0, 1]:
+                if len(index) > self.small_batch:
+                    self.sweep_axis(index, axis, solid, tile_size)
+                else:
+                    for i in index.tolist():
+                        self.sweep_body(i, axis, solid, tile_size)
+        vy = self.vel[index, 1]
+        vy[self.contacts[index, 1]] = 0
+        self.vel[index, 1] = np.where(vy > self.max_fall, self.max_fall, vy + self.gravity*self.g[index])
+        rest = index[self.contacts[index, 1] & (np.abs(self.vel[index, 0]) < self.rest_speed)]
+        self.resting[rest] = True
+        self.vel[rest] = 0
+
+    def sweep_body(self, i, axis, solid, tile_size):
+        # sweep_axis for a single body in plain python
+        pos, lane_pos = float(self.pos[i, axis]), float(self.pos[i, 1 - axis])
+        size, lane_size = int(self.size[i, axis]), int(self.size[i, 1 - axis])
+        delta = float(self.vel[i, axis])
+        lanes = range(math.floor(lane_pos / tile_size), math.ceil((lane_pos + lane_size) / tile_size))
+        forward = delta > 0
+        if forward:
+            first, end, step = math.ceil((pos + size) / tile_size), math.ceil((pos + size + delta) / tile_size), 1
+        else:
+            first, end, step = math.floor(pos / tile_size) - 1, math.floor((pos + delta) / tile_size) - 1, -1
+        moved = pos + delta
+        hit = False
+        rows, cols = solid.shape
+        for cell in range(first, end, step):
+            for lane in lanes:
+                row, col = (cell, lane) if axis else (lane, cell)
+                if 0 <= row < rows and 0 <= col < cols and solid[row, col]:
+                    moved = cell*tile_size - size if forward else (cell + 1)*tile_size
+                    hit = True
+                    break
+            if hit:
+                break
+        self.pos[i, axis] = moved
+        self.contacts[i, 3 - 2*axis] = hit and forward
+        self.contacts[i, 2 - 2*axis] = hit and not forward
+
+    def sweep_axis(self, index, axis, solid, tile_size):
+        # same walk as Physics2D.sweep: the cells entered by the leading edge, nearest first, across every lane
+        pos = self.pos[index, axis]
+        size = self.size[index, axis]
+        delta = self.vel[index, axis]
+        lane_pos = self.pos[index, 1 - axis]
+        lane_first = np.floor(lane_pos / tile_size).astype(int)
+        lane_last = np.ceil((lane_pos + self.size[index, 1 - axis]) / tile_size).astype(int) - 1
+        forward = delta > 0
+        first = np.where(forward, np.ceil((pos + size) / tile_size), np.floor(pos / tile_size) - 1).astype(int)
+        end = np.where(forward, np.ceil((pos + size + delta) / tile_size),
+                       np.floor((pos + delta) / tile_size) - 1).astype(int)
+        step = np.where(forward, 1, -1)
+        steps = np.abs(end - first)
+        moved = pos + delta
+        hit = np.zeros(len(index), dtype=bool)
+        rows, cols = solid.shape
+        for k in range(int(steps.max(initial=0))):
+            cell = first + k*step
+            active = (k < steps) & ~hit
+            blocked = np.zeros(len(index), dtype=bool)
+            for j in range(int((lane_last - lane_first).max(initial=0)) + 1):
+                lane = lane_first + j
+                row, col = (cell, lane) if axis else (lane, cell)
+                inside = active & (lane <= lane_last) & (row >= 0) & (row < rows) & (col >= 0) & (col < cols)
+                blocked[inside] |= solid[row[inside], col[inside]]
+            moved[blocked] = np.where(forward, cell*tile_size - size, (cell + 1)*tile_size)[blocked]
+            hit |= blocked
+        self.pos[index, axis] = moved
+        # contact columns are up, down, left, right
+        self.contacts[index, 3 - 2*axis] = hit & forward
+        self.contacts[index, 2 - 2*axis] = hit & ~forward
+
+
+class ParticleSystem:
+    """Fixed capacity particle pool kept packed at the front of its arrays and drawn in one blits call"""
+    kinds = {'splash': (35, 150, 230), 'dust': (150, 130, 110)}
+
+    def __init__(self, capacity=4096, gravity=0.15, stages=4, radius=3, seed=0):
+        self.capacity = capacity
+        self.gravity = gravity
+        self.count = 0
+        self.pos = np.zeros((capacity, 2))
+        self.vel = np.zeros((capacity, 2))
+        self.life = np.zeros(capacity, dtype=int)
+        self.max_life = np.ones(capacity, dtype=int)
+        self.kind = np.zeros(capacity, dtype=int)
+        self.rng = np.random.default_rng(seed)  # its own generator, so effects never shift the game's random stream
+        self.kind_names = list(self.kinds)
+        self.stages = stages
+        self.radius = radius
+        self.sprites = np.empty(len(self.kinds)*stages, dtype=object)
+        for k, colour in enumerate(self.kinds.values()):
+            for stage in range(stages):
+                self.sprites[k*stages + stage] = self.render_sprite(colour, stage)
+        # one [sprite, position] entry per slot, the positions being rows of dest so they are filled in one go
+        self.dest = np.zeros((capacity, 2), dtype=int)
+        self.sprite_index = np.zeros(capacity, dtype=int)
+        self.blit_sequence = [[self.sprites[0], self.dest[i]] for i in range(capacity)]
+
+    def render_sprite(self, colour, stage):
+        # later stages are smaller and more transparent
+        size = 2*self.radius + 1
+        sprite = pg.Surface((size, size), pg.SRCALPHA)
+        alpha = 255 - stage*200//self.stages
+        radius = max(1, self.radius - stage*self.radius//self.stages)
+        pg.draw.circle(sprite, colour + (alpha,), (self.radius, self.radius), radius)
+        return sprite
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.count = 0
+
+    def emit(self, kind, x, y, count, velocity=(0, 0), spread=1.0, life=30):
+        count = min(count, self.capacity - self.count)
+        if count <= 0:
+            return
+        new = slice(self.count, self.count + count)
+        self.pos[new] = x, y
+        self.vel[new] = self.rng.uniform(-spread, spread, (count, 2))
+        self.vel[new] += velocity
+        self.life[new] = self.rng.integers(life//2, life + 1, count)
+        self.max_life[new] = self.life[new]
+        self.kind[new] = self.kind_names.index(kind)
+        self.count += count
+
+    def step(self):
+        n = self.count
+        if not n:
+            return
+        self.pos[:n] += self.vel[:n]
+        self.vel[:n, 1] += self.gravity
+        self.life[:n] -= 1
+        alive = self.life[:n] > 0
+        if not alive.all():
+            keep = np.flatnonzero(alive)
+            for buffer in [self.pos, self.vel, self.life, self.max_life, self.kind]:
+                buffer[:len(keep)] = buffer[keep]
+            self.count = len(keep)
+
+    def draw(self, surface, offset):
+        n = self.count
+        if not n:
+            return
+        stage = self.stages - 1 - (self.life[:n]*self.stages - 1)//self.max_life[:n]
+        index = self.kind[:n]*self.stages + stage
+        # only slots whose sprite changed are touched from python
+        for i in np.flatnonzero(index != self.sprite_index[:n]).tolist():
+            self.blit_sequence[i][0] = self.sprites[index[i]]
+        self.sprite_index[:n] = index
+        self.dest[:n] = self.pos[:n] - offset - self.radius
+        blit_list(surface, islice(self.blit_sequence, n))
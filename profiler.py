@@ -0,0 +1,104 @@
+import json
+import time
+from collections import deque
+import pygame as pg
+
+
+class ProfileScope:
+    __slots__ = ['profiler', 'name', 'start']
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+
+class FrameProfiler:
+    """Named timing scopes per frame with rolling percentiles, an overlay and optional per-frame export"""
+
+    def __init__(self, window=240, export_path=None):
+        self.window = window
+        self.samples = {}  # name -> ms of the last `window` frames
+        self.current = {}
+        self.frame = 0
+        self.frame_start = None
+        self.visible = False
+        self.overlay = None
+        self.overlay_age = 0
+        self.font = None
+        self.export_file = None
+        self.export_csv = False
+        if export_path:
+            self.export_file = open(export_path, 'w')
+            self.export_csv = export_path.endswith('.csv')
+            if self.export_csv:
+                self.export_file.write('frame,scope,ms\n')
+
+    def scope(self, name):
+        return ProfileScope(self, name)
+
+    def add(self, name, ms):
+        self.current[name] = self.current.get(name, 0) + ms
+
+    def begin_frame(self):
+        self.current = {}
+        self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        if self.frame_start is not None:
+            self.current['frame'] = (time.perf_counter() - self.frame_start) * 1000
+        for name in self.samples.keys() | self.current.keys():
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.window)
+            self.samples[name].append(self.current.get(name, 0))
+        if self.export_file is not None:
+            if self.export_csv:
+                self.export_file.writelines(f"{self.frame},{name},{ms:.4f}\n" for name, ms in self.current.items())
+            else:
+                self.export_file.write(json.dumps({'frame': self.frame, **self.current}) + '\n')
+        self.frame += 1
+
+    def percentile(self, name, p):
+        ordered = sorted(self.samples.get(name, ()))
+        if not ordered:
+            return 0
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+    def stats(self, name):
+        return {p: self.percentile(name, p) for p in [50, 95, 99]}
+
+    def toggle(self):
+        self.visible = not self.visible
+        self.overlay = None
+
+    def draw(self, surface, refresh=15):
+        if not self.visible:
+            return None
+        # text is only re-rendered every `refresh` frames
+        if self.overlay is None or self.frame - self.overlay_age >= refresh:
+            if self.font is None:
+                self.font = pg.font.Font(None, 18)
+            lines = [f"{'scope':<12}{'p50':>7}{'p95':>7}{'p99':>7} ms"]
+            for name in sorted(self.samples, key=lambda n: (n != 'frame', n)):
+                stats = self.stats(name)
+                lines.append(f"{name:<12}{stats[50]:7.2f}{stats[95]:7.2f}{stats[99]:7.2f}")
+            rendered = [self.font.render(line, True, (255, 255, 255)) for line in lines]
+            self.overlay = pg.Surface((max(r.get_width() for r in rendered) + 8, 16 * len(rendered) + 8))
+            self.overlay.set_alpha(190)
+            for index, line in enumerate(rendered):
+                self.overlay.blit(line, (4, 4 + 16 * index))
+            self.overlay_age = self.frame
+        return surface.blit(self.overlay, (surface.get_width() - self.overlay.get_width(), 0))
+
+    def close(self):
+        if self.export_file is not None:
+            self.export_file.close()
+            self.export_file = None
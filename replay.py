@@ -0,0 +1,162 @@
+import sys
+import time
+import zlib
+import struct
+import argparse
+import pygame as pg
+
+# header: magic, version, random seed, ticks recorded; followed by the zlib compressed body
+HEADER = struct.Struct('<4sHII')
+MAGIC = b'PRPL'
+VERSION = 1
+CHECKSUM_INTERVAL = 60
+DIRECTIONS = ['up', 'down', 'left', 'right']
+
+
+def seed_arg(text):
+    # the seed is stored unsigned in the replay header
+    seed = int(text)
+    if not 0 <= seed < 2**32:
+        raise argparse.ArgumentTypeError(f"seed must be between 0 and {2**32 - 1}")
+    return seed
+
+
+def write_varint(out, value):
+    while value >= 0x80:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def state_checksum(screen):
+    player = screen.player
+    state = struct.pack('<4d', player.x, player.y, player.v[0], player.v[1])
+    return zlib.crc32(screen.water.heights.tobytes(), zlib.crc32(state))
+
+
+class ReplayRecorder:
+    """Collects player input transitions per tick and periodic state checksums, written out on close"""
+
+    def __init__(self, path, controls, seed=0, interval=CHECKSUM_INTERVAL):
+        self.path = path
+        self.controls = controls
+        self.seed = seed
+        self.interval = interval
+        self.events = []  # (tick, direction index, pressed)
+        self.checksums = []  # (tick, crc32 of the state after that tick)
+        self.ticks = 0
+
+    def record_event(self, tick, key, pressed):
+        for index, direction in enumerate(DIRECTIONS):
+            if self.controls[direction] == key:
+                self.events.append((tick, index, pressed))
+
+    def after_tick(self, tick, screen):
+        self.ticks = tick + 1
+        if self.ticks % self.interval == 0:
+            self.checksums.append((tick, state_checksum(screen)))
+
+    def close(self, screen=None):
+        if screen is not None and self.ticks and (not self.checksums or self.checksums[-1][0] != self.ticks - 1):
+            self.checksums.append((self.ticks - 1, state_checksum(screen)))
+        with open(self.path, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.seed, self.ticks))
+            f.write(zlib.compress(encode_body(self.events, self.checksums), 9))
+
+
+def encode_body(events, checksums):
+    # ticks are stored as the gap to the previous entry, which keeps them to a byte or two
+    body = bytearray()
+    write_varint(body, len(events))
+    last = 0
+    for tick, direction, pressed in events:
+        write_varint(body, tick - last)
+        body.append(direction << 1 | pressed)
+        last = tick
+    write_varint(body, len(checksums))
+    last = 0
+    for tick, crc in checksums:
+        write_varint(body, tick - last)
+        body += struct.pack('<I', crc)
+        last = tick
+    return bytes(body)
+
+
+def load_replay(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, seed, ticks = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} replay")
+    body = zlib.decompress(data[HEADER.size:])
+    count, offset = read_varint(body, 0)
+    events = []
+    tick = 0
+    for _ in range(count):
+        delta, offset = read_varint(body, offset)
+        tick += delta
+        events.append((tick, body[offset] >> 1, bool(body[offset] & 1)))
+        offset += 1
+    count, offset = read_varint(body, offset)
+    checksums = []
+    tick = 0
+    for _ in range(count):
+        delta, offset = read_varint(body, offset)
+        tick += delta
+        checksums.append((tick, struct.unpack_from('<I', body, offset)[0]))
+        offset += 4
+    return {'seed': seed, 'ticks': ticks, 'events': events, 'checksums': checksums}
+
+
+def play(replay, screen, controls):
+    """Re-simulate a loaded replay as fast as possible, returning the first tick whose checksum differs"""
+    events = {}
+    for tick, direction, pressed in replay['events']:
+        key = controls[DIRECTIONS[direction]]
+        events.setdefault(tick, []).append(pg.event.Event(pg.KEYDOWN if pressed else pg.KEYUP, key=key))
+    checksums = dict(replay['checksums'])
+    diverged = None
+    start = time.perf_counter()
+    for tick in range(replay['ticks']):
+        for event in events.get(tick, []):
+            screen.check_event(event)
+        screen.run()
+        if tick in checksums and state_checksum(screen) != checksums[tick]:
+            diverged = tick
+            break
+    seconds = time.perf_counter() - start
+    return {'ticks': tick + 1 if replay['ticks'] else 0, 'seconds': seconds, 'diverged': diverged}
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='Re-simulate a replay recorded with main.py --record.')
+    parser.add_argument('replay')
+    args = parser.parse_args()
+
+    import headless  # sets up the windowless video driver before pygame opens a display
+    replay = load_replay(args.replay)
+    controller, screen = headless.create_game(replay['seed'])
+    results = play(replay, screen, headless.main.CONTROLS['player'])
+    rate = results['ticks'] / results['seconds'] if results['seconds'] else 0
+    print(f"{results['ticks']} of {replay['ticks']} ticks in {results['seconds']:.3f}s -> {rate:.0f} ticks/s, "
+          f"{len(replay['events'])} input events, {len(replay['checksums'])} checksums")
+    pg.quit()
+    if results['diverged'] is not None:
+        print(f"state diverged from the recording at tick {results['diverged']}")
+        sys.exit(1)
+    print('state matched the recording at every checksum')
+
+
+if __name__ == '__main__':
+    cli()